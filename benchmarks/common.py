@@ -0,0 +1,124 @@
+''' Helpers shared by the benchmark scripts
+
+The scripts point credit_system at a throwaway database through the DB_FILE
+setting, so `use_temp_db()` has to run before anything from bot.mutual_credit
+is imported.
+'''
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+STATUSES = ('APPROVED', 'DENIED', 'CANCELLED')
+
+TAGS = ['books', 'bikes', 'childcare', 'cooking', 'electronics', 'garden',
+        'lessons', 'music', 'repairs', 'rides', 'tools', 'tutoring']
+
+
+def use_temp_db():
+    ''' Point DB_FILE at a new temporary directory, returns the path '''
+    path = os.path.join(tempfile.mkdtemp(prefix='mc-bench-'),
+                        'credit_system.db')
+    os.environ['DB_FILE'] = path
+    return path
+
+
+def cleanup(path):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed(accounts=100, offers=1000, tags=2, transactions=10000,
+         pending=0.02, rng=None):
+    ''' Fill the (empty) database, returns (account_ids, offers)
+
+    `offers` is a list of (offer_id, seller_id, price). Historical
+    transactions are spread over the past year and all but `pending` of them
+    are settled, so they only weigh on the queries rather than the balances.
+    '''
+    from bot.mutual_credit import credit_system as cs
+    from bot.mutual_credit import db
+
+    rng = rng or random.Random(0)
+    account_ids = list(range(1, accounts + 1))
+    created = []
+
+    with db.transaction() as conn:
+        for account_id in account_ids:
+            db.create_account(conn, (account_id, 0,
+                                     cs.DFLT_CONFIG['max_balance'],
+                                     cs.DFLT_CONFIG['min_balance']))
+        db.create_ledger_entries(conn, [
+            (account_id, None, 'CHECKPOINT', 0, 0)
+            for account_id in account_ids])
+
+        for i in range(offers):
+            seller_id = rng.choice(account_ids)
+            price = rng.randint(1, 20)
+            offer_id = db.create_offer(conn, (seller_id, f'description {i}',
+                                              price, f'offer {i}'))
+            created.append((offer_id, seller_id, price))
+
+            for tag in rng.sample(TAGS, min(tags, len(TAGS))):
+                db.create_offer_tag(conn, (offer_id, tag))
+
+        now = int(time.time())
+        rows = []
+
+        for _ in range(transactions):
+            offer_id, seller_id, _ = rng.choice(created)
+            buyer_id = rng.choice(account_ids)
+            start = now - rng.randint(0, 365 * 24 * 3600)
+
+            if rng.random() < pending:
+                rows.append((buyer_id, offer_id, 'PENDING', start, None))
+            else:
+                rows.append((buyer_id, offer_id, rng.choice(STATUSES), start,
+                             start + rng.randint(60, 7 * 24 * 3600)))
+
+        conn.executemany('''INSERT INTO transactions(buyer_id, offer_id, status,
+                                start_timestamp, end_timestamp)
+                            VALUES(?, ?, ?, ?, ?)''', rows)
+
+    cs.recomputePendingTotals()
+
+    return account_ids, created
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    ''' Nearest-rank percentiles of a list of seconds, in milliseconds '''
+    if not samples:
+        return {f'p{point}_ms': None for point in points}
+
+    samples = sorted(samples)
+    result = {}
+
+    for point in points:
+        rank = max(0, min(len(samples) - 1,
+                          round(point / 100 * len(samples)) - 1))
+        result[f'p{point}_ms'] = samples[rank] * 1000
+
+    return result
+
+
+def summarize(samples, errors, elapsed):
+    ''' Throughput and latency summary for one operation '''
+    return {
+        'count': len(samples),
+        'errors': errors,
+        'ops_per_sec': len(samples) / elapsed if elapsed else None,
+        'mean_ms': sum(samples) / len(samples) * 1000 if samples else None,
+        **percentiles(samples),
+        'max_ms': max(samples) * 1000 if samples else None,
+    }
@@ -0,0 +1,237 @@
+''' End-to-end command latency benchmark through MutualCreditClient.on_message
+
+Seeds a temporary database, registers a fake guild whose members own the
+seeded accounts, then replays a stream of commands through on_message at a
+target rate (open loop: commands are started on schedule whether or not
+earlier ones have finished). Prints per-command latency distributions and
+event loop lag as JSON:
+
+    python -m benchmarks.e2e --rate 200 --commands 5000 > e2e.json
+
+The stream is generated from a weighted mix, or read from a script file with
+one `MEMBER_ID COMMAND ARGS...` line per message (no command prefix), e.g.
+
+    3 account balance
+    3 transaction request 1k
+'''
+from . import common, fakes
+from bot.utils import to_public_id
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+
+
+DEFAULT_MIX = 'balance=30,offers=25,request=20,approve=10,deny=5,cancel=5,help=5'
+
+
+def generate(rng, count, mix, account_ids, offers, pending):
+    ''' Yields (member_id, command) pairs for the weighted mix
+
+    approve/deny/cancel use the pre-made pending requests in `pending`, a
+    list of (tx_id, buyer_id, seller_id), and become requests once it is
+    used up.
+    '''
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    for _ in range(count):
+        name = rng.choices(names, weights)[0]
+        member_id = rng.choice(account_ids)
+
+        if name in ('approve', 'deny', 'cancel') and pending:
+            tx_id, buyer_id, seller_id = pending.pop()
+            member_id = buyer_id if name == 'cancel' else seller_id
+            yield member_id, f'transaction {name} {to_public_id(tx_id)}'
+        elif name in ('request', 'approve', 'deny', 'cancel'):
+            offer_id = to_public_id(rng.choice(offers)[0])
+            yield member_id, f'transaction request {offer_id}'
+        elif name == 'balance':
+            yield member_id, 'account balance'
+        elif name == 'offers':
+            yield member_id, f'offer show <@{rng.choice(offers)[1]}>'
+        elif name == 'search':
+            # seeded offers are titled `offer N`
+            yield member_id, f'offer search offer {rng.randrange(len(offers))}'
+        elif name == 'help':
+            yield member_id, 'help'
+        else:
+            raise ValueError(f'Unknown command {name}')
+
+
+def read_script(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            member_id, command = line.split(None, 1)
+            yield int(member_id), command
+
+
+async def _watch_loop(interval, lags, done):
+    ''' Sample how late the event loop runs a callback that is due now '''
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def replay(client, members, stream, rate, reply_delay):
+    from bot import commands
+    from bot.client import COMMAND_PREFIX
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lags = []
+    done = asyncio.Event()
+
+    async def send(member_id, command):
+        message = fakes.Message(members[member_id], COMMAND_PREFIX + command,
+                                reply_delay)
+        entry, _ = commands.resolve(command.split())
+        key = f'{entry.command} {entry.name or ""}'.strip() if entry else command
+        start = time.perf_counter()
+
+        try:
+            await client.on_message(message)
+        except Exception:
+            errors[key] += 1
+
+        latencies[key].append(time.perf_counter() - start)
+
+    watcher = asyncio.ensure_future(_watch_loop(0.01, lags, done))
+    tasks = []
+    start = time.perf_counter()
+
+    for i, (member_id, command) in enumerate(stream):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(send(member_id, command)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    done.set()
+    await watcher
+
+    return {
+        'commands': len(tasks),
+        'elapsed': elapsed,
+        'target_rate': rate,
+        'achieved_rate': len(tasks) / elapsed if elapsed else None,
+        'latency': {key: common.summarize(times, errors[key], elapsed)
+                    for key, times in sorted(latencies.items())},
+        'loop_lag': {
+            'samples': len(lags),
+            'mean_ms': sum(lags) / len(lags) * 1000 if lags else None,
+            **common.percentiles(lags),
+            'max_ms': max(lags) * 1000 if lags else None,
+        },
+    }
+
+
+async def run(args, account_ids, offers, pending):
+    from bot.client import client
+    from bot.mutual_credit import async_credit_system as cs
+    from bot.ratelimit import RateLimiter
+
+    guild = fakes.Guild()
+    members = {account_id: guild.add_member(account_id, f'member{account_id}',
+                                            delay=args.reply_delay)
+               for account_id in account_ids}
+    await client.on_guild_join(guild)
+
+    if not args.rate_limit:
+        unlimited = (float('inf'), float('inf'))
+        client.limiter = RateLimiter({'read': unlimited, 'write': unlimited})
+
+    client.outbox.start()
+
+    if args.script:
+        stream = read_script(args.script)
+    else:
+        mix = {name: float(weight) for name, weight in
+               (part.split('=') for part in args.mix.split(','))}
+        stream = generate(random.Random(args.seed), args.commands, mix,
+                          account_ids, offers, pending)
+
+    result = await replay(client, members, stream, args.rate,
+                          args.reply_delay)
+
+    # let the outbox catch up so its DMs don't outlive the run
+    while await client.outbox.drain():
+        pass
+
+    result['notifications'] = client.notifier.stats()
+    result['queues'] = cs.queue_stats()
+    result['rate_limits'] = client.limiter.stats()
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--offers', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=2,
+                        help='tags per offer')
+    parser.add_argument('--transactions', type=int, default=20000,
+                        help='historical transactions to seed')
+    parser.add_argument('--pending', type=int, default=500,
+                        help='pending requests to make for approve/deny/cancel')
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=100,
+                        help='commands started per second')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='command=weight pairs, search can be added too')
+    parser.add_argument('--script', help='replay this file instead of --mix')
+    parser.add_argument('--reply-delay', type=float, default=0.0,
+                        help='simulated seconds per reply or DM')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per-member rate limiter enabled')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    path = common.use_temp_db()
+
+    from bot.mutual_credit import credit_system as cs
+    from bot.mutual_credit import db
+
+    try:
+        rng = random.Random(args.seed)
+        account_ids, offers = common.seed(args.accounts, args.offers,
+                                          args.tags, args.transactions,
+                                          rng=rng)
+        pending = []
+
+        for _ in range(args.pending):
+            offer_id, seller_id, _ = rng.choice(offers)
+            buyer_id = rng.choice([account_id for account_id in account_ids
+                                   if account_id != seller_id])
+            pending.append((cs.createTransaction(buyer_id, offer_id),
+                            buyer_id, seller_id))
+
+        result = asyncio.run(run(args, account_ids, offers, pending))
+
+        json.dump({
+            'benchmark': 'e2e',
+            'revision': common.git_revision(),
+            'config': vars(args),
+            **result,
+        }, sys.stdout, indent=2)
+        print()
+
+    finally:
+        db.get_pool().close()
+        common.cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
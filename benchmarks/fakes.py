@@ -0,0 +1,92 @@
+''' In-process stand-ins for the discord.py objects the bot touches
+
+Just enough of Guild, Member, Role, DMChannel and Message for
+MutualCreditClient's event handlers and the command modules to run without a
+gateway connection. Everything sent is recorded with a timestamp, and an
+optional delay on each send/reply stands in for the Discord API round trip.
+'''
+import asyncio
+import itertools
+import time
+
+
+_ids = itertools.count(10 ** 17)
+
+
+class Role:
+
+    def __init__(self, name):
+        self.id = next(_ids)
+        self.name = name
+
+
+class DMChannel:
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+
+
+    async def send(self, content):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append((time.perf_counter(), content))
+
+
+class Member:
+
+    def __init__(self, id, name, roles=(), guild=None, delay=0.0):
+        self.id = id
+        self.name = name
+        self.roles = list(roles)
+        self.guild = guild
+        self.dm_channel = None
+        self._delay = delay
+
+
+    def __str__(self):
+        return self.name
+
+
+    async def create_dm(self):
+        self.dm_channel = DMChannel(self._delay)
+        return self.dm_channel
+
+
+class Guild:
+
+    def __init__(self, name='bench', role_names=('member', 'admin')):
+        self.id = next(_ids)
+        self.name = name
+        self.roles = [Role(role_name) for role_name in role_names]
+        self.members = []
+
+
+    def role(self, name):
+        return next(role for role in self.roles if role.name == name)
+
+
+    def add_member(self, id, name, role_names=('member',), delay=0.0):
+        member = Member(id, name, [self.role(role_name)
+                                   for role_name in role_names], self, delay)
+        self.members.append(member)
+        return member
+
+
+class Message:
+
+    def __init__(self, author, content, delay=0.0):
+        self.author = author
+        self.content = content
+        self.delay = delay
+        self.replies = []
+
+
+    def __str__(self):
+        return f'<Message author={self.author} content={self.content!r}>'
+
+
+    async def reply(self, content):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.replies.append((time.perf_counter(), content))
@@ -0,0 +1,173 @@
+''' Database size and lookup time with text vs integer offer/transaction keys
+
+Builds a database at schema version 4 (uuid4 hex TEXT keys), measures its
+size and a set of key lookups, then applies the integer key migration and
+measures the same again:
+
+    python -m benchmarks.ids --transactions 200000 > ids.json
+'''
+from . import common
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+import uuid
+
+
+LEGACY_VERSION = 4
+
+
+def seed_legacy(conn, db, accounts, offers, tags, transactions, rng):
+    ''' Fill a version 4 database the way the text-keyed code did '''
+    account_ids = list(range(1, accounts + 1))
+    offer_rows = []
+
+    for account_id in account_ids:
+        db.create_account(conn, (account_id, 0, 1000, -1000))
+
+    for i in range(offers):
+        offer_rows.append((uuid.uuid4().hex, rng.choice(account_ids),
+                           f'description {i}', rng.randint(1, 20),
+                           f'offer {i}'))
+
+    conn.executemany('''INSERT INTO offers(id, seller_id, description, price,
+                            title)
+                        VALUES(?, ?, ?, ?, ?)''', offer_rows)
+    conn.executemany('''INSERT INTO offer_categories(offer_id, tag)
+                        VALUES(?, ?)''',
+                     [(offer[0], tag) for offer in offer_rows
+                      for tag in rng.sample(common.TAGS, tags)])
+
+    now = int(time.time())
+    conn.executemany('''INSERT INTO transactions(id, buyer_id, offer_id, status,
+                            start_timestamp, end_timestamp)
+                        VALUES(?, ?, ?, ?, ?, ?)''',
+                     [(uuid.uuid4().hex, rng.choice(account_ids),
+                       rng.choice(offer_rows)[0],
+                       rng.choice(common.STATUSES + ('PENDING',)),
+                       now - rng.randint(0, 365 * 24 * 3600), None)
+                      for _ in range(transactions)])
+    conn.commit()
+
+
+def measure(conn, db, path, repeat, rng):
+    conn.execute('VACUUM')
+    conn.execute('ANALYZE')
+
+    tx_ids = [row[0] for row in
+              conn.execute('SELECT id FROM transactions').fetchall()]
+    offer_ids = [row[0] for row in
+                 conn.execute('SELECT id FROM offers').fetchall()]
+    seller_ids = [row[0] for row in
+                  conn.execute('SELECT DISTINCT seller_id FROM offers')]
+
+    lookups = {
+        'get_transaction': lambda: db.get_transaction(conn, rng.choice(tx_ids)),
+        'get_settlement_info':
+            lambda: db.get_settlement_info(conn, rng.choice(tx_ids)),
+        'get_offer_with_categories':
+            lambda: db.get_offer_with_categories(conn, rng.choice(offer_ids)),
+        'get_pending_tx_for_offer':
+            lambda: db.get_pending_tx_for_offer(conn, rng.choice(offer_ids)),
+        'get_pending_tx_for_seller':
+            lambda: db.get_pending_tx_for_seller(conn, rng.choice(seller_ids),
+                                                 limit=10),
+    }
+    timings = {}
+
+    for name, call in lookups.items():
+        samples = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - start)
+
+        timings[name] = {
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            **common.percentiles(samples),
+        }
+
+    try:
+        tables = dict(conn.execute('''SELECT name, sum(pgsize) FROM dbstat
+                                      GROUP BY name ORDER BY name'''))
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table
+        tables = None
+
+    return {
+        'file_bytes': os.path.getsize(path),
+        'table_bytes': tables,
+        'lookups': timings,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--offers', type=int, default=20000)
+    parser.add_argument('--tags', type=int, default=2,
+                        help='tags per offer')
+    parser.add_argument('--transactions', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='calls per timed lookup')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    path = common.use_temp_db()
+
+    from bot.mutual_credit import db, migrations
+
+    legacy_path = os.path.join(os.path.dirname(path), 'legacy.db')
+    migrated_path = os.path.join(os.path.dirname(path), 'migrated.db')
+
+    try:
+        conn = sqlite3.connect(legacy_path)
+        db.init_accounts_table(conn)
+        db.init_offers_table(conn)
+        db.init_offer_categories_table(conn)
+        db.init_transactions_table(conn)
+        db.init_connection(conn)
+        migrations.migrate(conn, target=LEGACY_VERSION)
+
+        seed_legacy(conn, db, args.accounts, args.offers, args.tags,
+                    args.transactions, random.Random(args.seed))
+        before = measure(conn, db, legacy_path, args.repeat,
+                         random.Random(args.seed))
+        conn.close()
+
+        shutil.copy(legacy_path, migrated_path)
+        conn = sqlite3.connect(migrated_path)
+        db.init_connection(conn)
+
+        start = time.perf_counter()
+        migrations.migrate(conn)
+        migration_time = time.perf_counter() - start
+
+        after = measure(conn, db, migrated_path, args.repeat,
+                        random.Random(args.seed))
+        conn.close()
+
+        json.dump({
+            'benchmark': 'ids',
+            'revision': common.git_revision(),
+            'config': vars(args),
+            'text_keys': before,
+            'integer_keys': after,
+            'migration_seconds': migration_time,
+            'size_ratio': after['file_bytes'] / before['file_bytes'],
+        }, sys.stdout, indent=2)
+        print()
+
+    finally:
+        db.get_pool().close()
+        common.cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+''' Mixed-workload throughput benchmark for credit_system
+
+Seeds a temporary database, then runs the same mix of ledger operations from
+each requested number of threads and prints ops/sec and latency percentiles
+per operation as JSON:
+
+    python -m benchmarks.load --threads 1,2,4,8 --ops 2000 > results.json
+
+Each thread count starts from a copy of the same seeded database, so runs
+are comparable with each other and across commits.
+'''
+from . import common
+
+import argparse
+import collections
+import json
+import random
+import shutil
+import sys
+import threading
+import time
+
+
+DEFAULT_MIX = 'request=30,approve=15,deny=5,cancel=5,balance=30,offers=15'
+
+
+def parse_mix(text):
+    mix = {}
+
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+
+    return mix
+
+
+class Workload:
+    ''' Shared state for the worker threads of one run
+
+    Pending requests made during the run are kept so approve, deny and
+    cancel have something to settle; when there are none those operations
+    fall back to a request.
+    '''
+
+    def __init__(self, cs, account_ids, offers, mix):
+        self.cs = cs
+        self.account_ids = account_ids
+        self.offers = offers
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+
+    def _take_pending(self):
+        with self._lock:
+            return self._pending.popleft() if self._pending else None
+
+
+    def request(self, rng):
+        offer_id, seller_id, _ = rng.choice(self.offers)
+        buyer_id = rng.choice(self.account_ids)
+
+        # buying from yourself isn't an interesting case here
+        while buyer_id == seller_id and len(self.account_ids) > 1:
+            buyer_id = rng.choice(self.account_ids)
+
+        tx_id = self.cs.createTransaction(buyer_id, offer_id)
+
+        with self._lock:
+            self._pending.append((tx_id, buyer_id, seller_id))
+
+
+    def _settle(self, rng, name):
+        pending = self._take_pending()
+
+        if pending is None:
+            self.request(rng)
+            return 'request'
+
+        tx_id, buyer_id, seller_id = pending
+
+        if name == 'approve':
+            self.cs.approveTransaction(seller_id, tx_id)
+        elif name == 'deny':
+            self.cs.denyTransaction(seller_id, tx_id)
+        else:
+            self.cs.cancelTransaction(buyer_id, tx_id)
+
+        return name
+
+
+    def pick(self, rng):
+        return rng.choices(self.names, self.weights)[0]
+
+
+    def perform(self, name, rng):
+        ''' Run one operation, returns the name of the one actually run '''
+        if name == 'request':
+            self.request(rng)
+        elif name in ('approve', 'deny', 'cancel'):
+            return self._settle(rng, name)
+        elif name == 'balance':
+            self.cs.getAvailableBalance(rng.choice(self.account_ids))
+        elif name == 'offers':
+            _, seller_id, _ = rng.choice(self.offers)
+            self.cs.getOffers(seller_id, limit=10)
+        else:
+            raise ValueError(f'Unknown operation {name}')
+
+        return name
+
+
+def run(workload, threads, ops, seed):
+    samples = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        local = collections.defaultdict(list)
+        failed = collections.Counter()
+        barrier.wait()
+
+        for _ in range(ops):
+            name = workload.pick(rng)
+            start = time.perf_counter()
+
+            try:
+                name = workload.perform(name, rng)
+            except Exception:
+                # e.g. a buyer at their balance limit, still a timed call
+                failed[name] += 1
+            local[name].append(time.perf_counter() - start)
+
+        with lock:
+            for name, times in local.items():
+                samples[name].extend(times)
+            errors.update(failed)
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+
+    for thread in workers:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+
+    for thread in workers:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+    total = sum(len(times) for times in samples.values())
+
+    return {
+        'threads': threads,
+        'elapsed': elapsed,
+        'ops_per_sec': total / elapsed if elapsed else None,
+        'operations': {name: common.summarize(times, errors[name], elapsed)
+                       for name, times in sorted(samples.items())},
+        'errors': dict(errors),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--offers', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=2,
+                        help='tags per offer')
+    parser.add_argument('--transactions', type=int, default=20000,
+                        help='historical transactions to seed')
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help='comma separated thread counts to run')
+    parser.add_argument('--ops', type=int, default=1000,
+                        help='operations per thread')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='operation=weight pairs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    path = common.use_temp_db()
+
+    from bot.mutual_credit import credit_system as cs
+    from bot.mutual_credit import db
+
+    try:
+        account_ids, offers = common.seed(args.accounts, args.offers,
+                                          args.tags, args.transactions,
+                                          rng=random.Random(args.seed))
+        db.get_pool().close()
+        shutil.copy(path, path + '.seed')
+
+        runs = []
+
+        for threads in [int(n) for n in args.threads.split(',')]:
+            # start every run from the same data
+            db.get_pool().close()
+            shutil.copy(path + '.seed', path)
+
+            workload = Workload(cs, account_ids, offers, parse_mix(args.mix))
+            runs.append(run(workload, threads, args.ops, args.seed))
+            print(f'{threads} threads: {runs[-1]["ops_per_sec"]:.0f} ops/sec',
+                  file=sys.stderr)
+
+        with db.connect() as conn:
+            pragmas = db.get_pragmas(conn)
+
+        json.dump({
+            'benchmark': 'load',
+            'revision': common.git_revision(),
+            'config': vars(args),
+            'sqlite': pragmas,
+            'runs': runs,
+            'pool': cs.getPoolStats(),
+            'locks': cs.getLockStats(),
+        }, sys.stdout, indent=2)
+        print()
+
+    finally:
+        db.get_pool().close()
+        common.cleanup(path)
+
+
+if __name__ == '__main__':
+    main()
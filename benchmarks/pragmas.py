@@ -0,0 +1,91 @@
+''' Compare SQLite PRAGMA profiles on the load benchmark
+
+Runs benchmarks.load once per profile, each in its own process with the
+profile's DB_* settings in the environment, and prints the results side by
+side as JSON:
+
+    python -m benchmarks.pragmas --threads 1,4 --ops 1000 > pragmas.json
+
+Any other arguments are passed through to benchmarks.load.
+'''
+from . import common
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+PROFILES = {
+    # SQLite's own defaults, what the bot used before the profile existed
+    'rollback': {
+        'DB_JOURNAL_MODE': 'DELETE',
+        'DB_SYNCHRONOUS': 'FULL',
+        'DB_MMAP_SIZE': '0',
+        'DB_CACHE_SIZE': '-2000',
+        'DB_TEMP_STORE': 'DEFAULT',
+    },
+    'wal-full': {
+        'DB_JOURNAL_MODE': 'WAL',
+        'DB_SYNCHRONOUS': 'FULL',
+    },
+    # the defaults in db.py
+    'default': {},
+    # not crash safe, here to show what the fsyncs cost
+    'wal-off': {
+        'DB_JOURNAL_MODE': 'WAL',
+        'DB_SYNCHRONOUS': 'OFF',
+    },
+}
+
+SETTINGS = ('DB_JOURNAL_MODE', 'DB_SYNCHRONOUS', 'DB_MMAP_SIZE',
+            'DB_CACHE_SIZE', 'DB_TEMP_STORE', 'DB_BUSY_TIMEOUT')
+
+
+def run_profile(settings, load_args):
+    # start from the db.py defaults rather than whatever is set here
+    env = {key: value for key, value in os.environ.items()
+           if key not in SETTINGS}
+    env.update(settings)
+
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.load',
+                             *load_args],
+                            env=env, stdout=subprocess.PIPE, text=True,
+                            check=True).stdout
+
+    return json.loads(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--profiles', default=','.join(PROFILES),
+                        help='comma separated names from PROFILES')
+    args, load_args = parser.parse_known_args(argv)
+
+    results = {}
+
+    for name in args.profiles.split(','):
+        print(f'profile {name}', file=sys.stderr)
+        result = run_profile(PROFILES[name], load_args)
+        results[name] = {
+            'settings': PROFILES[name],
+            'effective': result['sqlite'],
+            'runs': [{
+                'threads': run['threads'],
+                'ops_per_sec': run['ops_per_sec'],
+                'operations': run['operations'],
+            } for run in result['runs']],
+        }
+
+    json.dump({
+        'benchmark': 'pragmas',
+        'revision': common.git_revision(),
+        'load_args': load_args,
+        'profiles': results,
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
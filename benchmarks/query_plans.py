@@ -0,0 +1,248 @@
+''' Query plan checks and scaling timings for the SQL in db.py
+
+Every SQL statement assigned to `sql` in bot/mutual_credit/db.py is found by
+parsing the module, rendered (f-string helpers included) and run through
+EXPLAIN QUERY PLAN against a seeded database. A statement whose plan falls
+back to a full SCAN of transactions (live or archived), offers or
+ledger_entries fails the check unless it is listed in ALLOWED_SCANS. The hot read queries are then timed at each
+database size:
+
+    python -m benchmarks.query_plans --sizes 10000,100000,1000000 > plans.json
+
+`--check-only` skips the timings and only checks plans on a small database.
+The exit status is 1 when a plan check fails, so this can run in CI.
+'''
+from . import common
+
+import argparse
+import ast
+import inspect
+import json
+import random
+import re
+import subprocess
+import sys
+import time
+
+
+SCANNED_TABLES = ('transactions', 'transactions_history', 'offers',
+                  'ledger_entries')
+
+# function name -> why a full scan is fine there
+ALLOWED_SCANS = {
+    'compute_pending_totals': 'maintenance job, reads every account anyway',
+}
+
+# values for the names used inside db.py f-strings, with `after` set so the
+# keyset pagination variant is the one checked
+FSTRING_NAMES = {
+    'after': ('x', 'x'),
+    'account_ids': [1, 2, 3],
+    'offer_ids': ['a', 'b', 'c'],
+    'tags': ['a', 'b', 'c'],
+    'tx_ids': ['a', 'b', 'c'],
+}
+
+# tables read through all_transactions are reported with their schema
+SCAN = re.compile(r'^SCAN (?:\w+\.)?(\w+)(?: AS (\w+))?')
+
+
+def extract_statements(db):
+    ''' Returns [(function name, sql)] for every `sql = ...` in db.py '''
+    tree = ast.parse(inspect.getsource(db))
+    namespace = {**vars(db), **FSTRING_NAMES}
+    statements = []
+
+    for func in tree.body:
+        if not isinstance(func, ast.FunctionDef):
+            continue
+
+        for node in ast.walk(func):
+            if not (isinstance(node, ast.Assign) and
+                    any(isinstance(target, ast.Name) and target.id == 'sql'
+                        for target in node.targets)):
+                continue
+
+            expr = ast.Expression(node.value)
+            sql = eval(compile(expr, db.__file__, 'eval'), namespace)
+            statements.append((func.name, sql))
+
+    return statements
+
+
+def _aliases(sql):
+    ''' alias -> table for the `FROM/JOIN table as alias` clauses '''
+    pattern = r'(?:FROM|JOIN)\s+(\w+)(?:\s+as\s+(\w+))?'
+    return {(alias or table): table
+            for table, alias in re.findall(pattern, sql, re.IGNORECASE)}
+
+
+def check_plan(conn, name, sql):
+    ''' Returns (plan lines, list of tables fully scanned) '''
+    params = [None] * sql.count('?')
+    plan = [row[3] for row in
+            conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+    aliases = _aliases(sql)
+    scanned = []
+
+    for detail in plan:
+        match = SCAN.match(detail)
+        if not match:
+            continue
+
+        table = aliases.get(match.group(2) or match.group(1), match.group(1))
+        if table in SCANNED_TABLES:
+            scanned.append(table)
+
+    return plan, scanned
+
+
+def timed_calls(db, conn, sample):
+    ''' name -> zero-argument call of a hot read query with real ids '''
+    tx_id, buyer_id, offer_id, seller_id = sample
+
+    return {
+        'get_account_snapshot': lambda: db.get_account_snapshot(conn, buyer_id),
+        'get_due_outbox_messages':
+            lambda: db.get_due_outbox_messages(conn, 8, 50),
+        'get_offer_categories':
+            lambda: db.get_offer_categories(conn.cursor(), offer_id),
+        'get_offer_with_categories':
+            lambda: db.get_offer_with_categories(conn, offer_id),
+        'get_offers_by_seller':
+            lambda: db.get_offers_by_seller(conn.cursor(), seller_id, limit=10),
+        'get_offers_with_categories':
+            lambda: db.get_offers_with_categories(conn, seller_id, limit=10),
+        'get_pending_tx_for_buyer':
+            lambda: db.get_pending_tx_for_buyer(conn.cursor(), buyer_id,
+                                                limit=10),
+        'get_pending_tx_for_offer':
+            lambda: db.get_pending_tx_for_offer(conn, offer_id),
+        'get_pending_tx_for_seller':
+            lambda: db.get_pending_tx_for_seller(conn, seller_id, limit=10),
+        'get_settlement_info': lambda: db.get_settlement_info(conn, tx_id),
+        'get_settlement_infos':
+            lambda: db.get_settlement_infos(conn, [tx_id]),
+        'get_total_pending_credits_by_account':
+            lambda: db.get_total_pending_credits_by_account(conn, seller_id),
+        'get_transaction': lambda: db.get_transaction(conn, tx_id),
+    }
+
+
+def time_queries(db, repeat):
+    with db.connect() as conn:
+        tx_id, buyer_id, offer_id = conn.execute(
+            '''SELECT id, buyer_id, offer_id FROM transactions
+               WHERE status="PENDING" LIMIT 1''').fetchone()
+        seller_id = db.get_offer_seller(conn, offer_id)
+
+        results = {}
+
+        for name, call in timed_calls(db, conn, (tx_id, buyer_id, offer_id,
+                                                 seller_id)).items():
+            samples = []
+
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call()
+                samples.append(time.perf_counter() - start)
+
+            results[name] = {
+                'mean_ms': sum(samples) / len(samples) * 1000,
+                **common.percentiles(samples),
+            }
+
+    return results
+
+
+def run_size(rows, repeat, check_only, seed):
+    ''' Seed a fresh database with `rows` transactions and measure it '''
+    path = common.use_temp_db()
+
+    from bot.mutual_credit import db
+
+    try:
+        start = time.perf_counter()
+        common.seed(accounts=max(10, rows // 100), offers=max(10, rows // 10),
+                    transactions=rows, rng=random.Random(seed))
+        seeded = time.perf_counter() - start
+
+        failures = []
+        plans = {}
+
+        with db.connect() as conn:
+            conn.execute('ANALYZE')
+
+            for name, sql in extract_statements(db):
+                plan, scanned = check_plan(conn, name, sql)
+                plans.setdefault(name, []).append(plan)
+
+                if scanned and name not in ALLOWED_SCANS:
+                    failures.append({'function': name, 'scans': scanned,
+                                     'plan': plan})
+
+        result = {'rows': rows, 'seed_time': seeded, 'failures': failures,
+                  'plans': plans}
+
+        if not check_only:
+            result['timings'] = time_queries(db, repeat)
+
+        return result
+
+    finally:
+        db.get_pool().close()
+        common.cleanup(path)
+
+
+def run_subprocess(rows, args):
+    command = [sys.executable, '-m', 'benchmarks.query_plans',
+               '--sizes', str(rows), '--repeat', str(args.repeat),
+               '--seed', str(args.seed)]
+    output = subprocess.run(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True).stdout
+
+    return json.loads(output)['sizes'][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated transaction counts')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='calls per timed query')
+    parser.add_argument('--check-only', action='store_true',
+                        help='only check plans, on a 1000 row database')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sizes = [1000] if args.check_only else \
+        [int(size) for size in args.sizes.split(',')]
+
+    if len(sizes) == 1:
+        results = [run_size(sizes[0], args.repeat, args.check_only, args.seed)]
+    else:
+        # DB_FILE is read once per process, so each size gets its own
+        results = [run_subprocess(rows, args) for rows in sizes]
+
+    for result in results:
+        print(f'{result["rows"]} rows: {len(result["failures"])} plan failures',
+              file=sys.stderr)
+
+        for failure in result['failures']:
+            print(f'FAIL {failure["function"]}: full scan of '
+                  f'{", ".join(failure["scans"])}: {failure["plan"]}',
+                  file=sys.stderr)
+
+    json.dump({
+        'benchmark': 'query_plans',
+        'revision': common.git_revision(),
+        'config': vars(args),
+        'sizes': results,
+    }, sys.stdout, indent=2)
+    print()
+
+    return 1 if any(result['failures'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,14 +7,20 @@ except:
     os.environ['COMMAND_PREFIX'] = COMMAND_PREFIX
 
 
-from . import account, help, kill, offer, tag, transaction
+# imported for their @subcommand registrations
+from . import account, commands, help, kill, offer, stats, tag, transaction
 
+from .maintenance import MaintenanceWorker
 from .mutual_credit.errors import UserPermissionError
+from .notifications import NotificationDispatcher
+from .outbox import OutboxWorker
+from .ratelimit import RateLimiter
 
-from .utils import find_subcommands, mention_to_id
+from .utils import mention_to_id
 
 import discord
 from discord.utils import get
+import math
 import shlex
 import logging
 
@@ -30,45 +36,125 @@ class MutualCreditClient (discord.Client):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # member id -> {guild id -> role names}, kept current by the
+        # member/role events below so permission checks don't scan members
+        self._guild_roles = {}
+        self._member_roles = {}
+        self._members = {}
+        self.notifier = NotificationDispatcher(self)
+        self.outbox = OutboxWorker(self)
+        self.maintenance = MaintenanceWorker()
+        self.limiter = RateLimiter()
+
+
+    def _index_member(self, member):
+        names = frozenset(role.name for role in member.roles)
+        guild_roles = self._guild_roles.setdefault(member.id, {})
+        guild_roles[member.guild.id] = names
+        self._member_roles[member.id] = frozenset().union(*guild_roles.values())
+        self._members[member.id] = member
+
+
+    def _unindex_member(self, member):
+        guild_roles = self._guild_roles.get(member.id, {})
+        guild_roles.pop(member.guild.id, None)
+
+        if guild_roles:
+            self._member_roles[member.id] = frozenset().union(*guild_roles.values())
+            return
+
+        self._guild_roles.pop(member.id, None)
+        self._member_roles.pop(member.id, None)
+        self._members.pop(member.id, None)
+
+
+    def _index_guild(self, guild):
+        for member in guild.members:
+            self._index_member(member)
+
+        log.info(f'indexed {len(guild.members)} members of guild {guild.id}')
+
+
+    def _unindex_guild(self, guild):
+        for member in guild.members:
+            self._unindex_member(member)
+
+
+    def member_for(self, member_id):
+        return self._members.get(member_id)
 
 
-    async def on_command(self, message):
-        args = shlex.split(message.content)
+    def roles_for(self, member_id):
+        return self._member_roles.get(member_id, frozenset())
 
+
+    async def on_command(self, message, args):
         user = message.author
 
         log.info(f'{message}')
 
-        cmd = args[1]
-        args = args[2:]
-
         try:
-            # non-member commands
-            #func = getattr(self, 'handle_' + cmd)
-            if cmd == 'account':
-                await account.handle(client, message, args)
-            elif cmd == 'tag':
-                await tag.handle(client, message, args)
-            elif cmd == 'offer':
-                await offer.handle(client, message, args)
-            elif cmd == 'help':
-                await help.handle(client, message, args)
-            elif cmd == 'kill':
-                await kill.handle(client, message, args)
-            elif cmd == 'transaction':
-                await transaction.handle(client, message, args)
-            else:
-                await message.reply('I don\'t know that command')
+            await commands.dispatch(self, message, args)
 
         except Exception as e:
             await message.reply(str(e))
             raise e
 
+
+    # charges the member's read or write bucket by the subcommand's cost, so
+    # a bulk command costs as much as the single commands it replaces
+    async def _allow(self, message, args):
+        entry, sub_args = commands.resolve(args)
+        kind = 'write' if entry and entry.writes else 'read'
+        cost = commands.cost(entry, sub_args) if entry else 1
+        wait = self.limiter.acquire(message.author.id, kind, cost)
+
+        if not wait:
+            return True
+
+        log.warning(f'{message.author} throttled ({kind}, cost {cost})')
+
+        if wait == float('inf'):
+            await message.reply('That command has too many arguments, '
+                                'please split it into smaller ones.')
+        else:
+            await message.reply('You are sending commands too quickly, '
+                                f'try again in {math.ceil(wait)} seconds.')
+
+        return False
+
+
+    async def on_guild_join(self, guild):
+        self._index_guild(guild)
+
+
+    async def on_guild_remove(self, guild):
+        self._unindex_guild(guild)
+
+
+    async def on_guild_role_delete(self, role):
+        self._index_guild(role.guild)
+
+
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name:
+            for member in after.members:
+                self._index_member(member)
+
+
+    async def on_member_join(self, member):
+        self._index_member(member)
+
+
+    async def on_member_remove(self, member):
+        self._unindex_member(member)
+
+
     async def on_member_update(self, before, after):
+        self._index_member(after)
         # TODO: check if member just recieved the 'member' role
         #       and if true: create a new account for them (if one does not)
         #       already exist
-        pass
 
 
     async def on_message(self, message):
@@ -81,7 +167,12 @@ class MutualCreditClient (discord.Client):
             return
 
         try:
-            await self.on_command(message)
+            args = shlex.split(message.content)[1:]
+
+            if not await self._allow(message, args):
+                return
+
+            await self.on_command(message, args)
         except UserPermissionError as e:
             await message.reply('You don\'t have permission to do that')
         except Exception as e:
@@ -90,6 +181,12 @@ class MutualCreditClient (discord.Client):
 
 
     async def on_ready(self):
+        for guild in self.guilds:
+            self._index_guild(guild)
+
+        self.outbox.start()
+        self.maintenance.start()
+
         print('MutualCreditClient ready')
 
 
@@ -0,0 +1,143 @@
+from .mutual_credit.errors import AccountIDError
+
+from .utils import get_roles
+
+from collections import namedtuple
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# this way instead of `os.getenv(...)` to make sure that it's set
+COMMAND_PREFIX = os.environ['COMMAND_PREFIX']
+
+
+Subcommand = namedtuple('Subcommand', [
+    'command',
+    'name',
+    'func',
+    'roles',
+    'min_args',
+    'max_args',
+    'usage',
+    'writes',
+    'pass_roles',
+    'cost',
+])
+
+
+# (command, subcommand) -> Subcommand, filled in as the command modules are
+# imported. A subcommand name of None handles the bare command.
+_registry = {}
+
+# 'command subcommand' -> call count and timings in seconds
+_timings = {}
+
+ROLE_ERRORS = {
+    'admin': 'You do not have permission to do that.',
+    'member': 'You are not a member.',
+}
+
+
+def subcommand(command, name=None, roles=('member',), min_args=0,
+               max_args=None, usage=None, writes=False, pass_roles=False,
+               cost=1):
+    ''' Register a handler for `COMMAND_PREFIX command name args...`
+
+    The handler is called as func(client, message, args), plus roles=... if
+    pass_roles is set. Callers must have every role in `roles` and pass
+    between min_args and max_args arguments (None means no maximum).
+    `writes` marks handlers that change the ledger. `cost` is the rate
+    limit tokens a call takes, a number or a function of the arguments.
+    '''
+    def decorator(func):
+        key = (command, name)
+        if key in _registry:
+            raise ValueError(f'{command} {name} is already registered')
+
+        _registry[key] = Subcommand(command, name, func, tuple(roles),
+                                    min_args, max_args, usage, writes,
+                                    pass_roles, cost)
+        return func
+
+    return decorator
+
+
+def commands():
+    return sorted({command for command, _ in _registry})
+
+
+def subcommands(command):
+    return sorted(name for cmd, name in _registry if cmd == command and name)
+
+
+def resolve(args):
+    ''' Find the Subcommand for command arguments, returns (entry, args) '''
+    if len(args) < 1:
+        return None, args
+
+    command, args = args[0], args[1:]
+
+    if args and (command, args[0]) in _registry:
+        return _registry[(command, args[0])], args[1:]
+
+    return _registry.get((command, None)), args
+
+
+def cost(entry, args):
+    ''' Rate limit tokens for calling entry with args, at least one '''
+    tokens = entry.cost(args) if callable(entry.cost) else entry.cost
+    return max(1, tokens)
+
+
+def _record(entry, elapsed):
+    key = f'{entry.command} {entry.name or ""}'.strip()
+    timing = _timings.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0})
+    timing['count'] += 1
+    timing['total'] += elapsed
+    timing['max'] = max(timing['max'], elapsed)
+
+
+def command_stats():
+    return {key: dict(timing, avg=timing['total'] / timing['count'])
+            for key, timing in _timings.items()}
+
+
+async def dispatch(client, message, args):
+    entry, sub_args = resolve(args)
+
+    if entry is None:
+        if args and args[0] in commands():
+            if len(args) < 2:
+                raise Exception('Must provide a sub-command')
+            await message.reply('I don\'t know that sub-command!')
+        else:
+            await message.reply('I don\'t know that command')
+        return
+
+    roles = get_roles(client, message.author.id)
+
+    for role in entry.roles:
+        if role not in roles:
+            log.warning(f'{message.author} lacks role {role} for {args}')
+            raise Exception(ROLE_ERRORS.get(role, 'You do not have permission to do that.'))
+
+    if len(sub_args) < entry.min_args or (
+            entry.max_args is not None and len(sub_args) > entry.max_args):
+        if entry.usage:
+            raise Exception(f'Usage: `{COMMAND_PREFIX}{entry.usage}`')
+        raise Exception('Invalid number of arguments')
+
+    kwargs = {'roles': roles} if entry.pass_roles else {}
+    start = time.perf_counter()
+
+    try:
+        await entry.func(client, message, sub_args, **kwargs)
+    except AccountIDError as e:
+        log.info(e)
+        await message.reply('You need an account to do that.')
+    finally:
+        elapsed = time.perf_counter() - start
+        _record(entry, elapsed)
+        log.debug(f'dispatch: {entry.command} {entry.name} took {elapsed:.4f}s')
@@ -1,4 +1,4 @@
-from .utils import role_check
+from .commands import subcommand
 
 import os
 import shlex
@@ -10,9 +10,9 @@ log = logging.getLogger(__name__)
 COMMAND_PREFIX = os.environ['COMMAND_PREFIX']
 
 
-async def subcmd_long(client, message, args, is_admin=False):
-    if len(args) > 0:
-        raise Exception(f'This command takes no arguments.')
+@subcommand('help', 'full', max_args=0, usage='help [full]', pass_roles=True)
+async def subcmd_long(client, message, args, roles=frozenset()):
+    is_admin = 'admin' in roles
 
     response = f'''
 {COMMAND_PREFIX}help output
@@ -33,6 +33,12 @@ async def subcmd_long(client, message, args, is_admin=False):
 
 **Remote one or more categories from an offer (member-only)**
 `{COMMAND_PREFIX}tag remove OFFER_ID TAG [TAG ...]`
+
+**Show offers that have all of the given categories (member-only)**
+`{COMMAND_PREFIX}tag browse TAG [TAG ...] [--after OFFER_ID]`
+
+**Show the most used categories and how many offers have each (member-only)**
+`{COMMAND_PREFIX}tag list`
 '''
 
     if is_admin:
@@ -42,6 +48,9 @@ async def subcmd_long(client, message, args, is_admin=False):
 
 **Kill the bot (admin-only)**
 `{COMMAND_PREFIX}kill`
+
+**Show rate limit, database and notification counters (admin-only)**
+`{COMMAND_PREFIX}stats`
 '''
 
     response += f'''
@@ -53,7 +62,11 @@ async def subcmd_long(client, message, args, is_admin=False):
 
 **Show offers from an account (member-only)**
 *`@USER` indicates that your should use a `mention` ('@' someone)*
-`{COMMAND_PREFIX}offer show @USER`
+`{COMMAND_PREFIX}offer show [@USER] [--page N | --after OFFER_ID]`
+
+**Search the offers of every member (member-only)**
+*Finds offers with all of the words in their title or description, best match first*
+`{COMMAND_PREFIX}offer search WORDS [--tag TAG] [--max-price N] [--page N]`
 
 **Approve a transfer request from someone (member-only)**
 *The buyer(s) will be notified that you have denied their request(s)*
@@ -75,9 +88,10 @@ async def subcmd_long(client, message, args, is_admin=False):
     await message.reply(response)
 
 
-async def subcmd_short(client, message, args, is_admin=False):
-    if len(args) > 0:
-        raise Exception(f'This command takes no arguments.')
+# `help anything-else` lands here too and gets the short help, as it always has
+@subcommand('help', usage='help [full]', pass_roles=True)
+async def subcmd_short(client, message, args, roles=frozenset()):
+    is_admin = 'admin' in roles
 
     response = f'''
 {COMMAND_PREFIX}help output
@@ -86,43 +100,23 @@ async def subcmd_short(client, message, args, is_admin=False):
 `{COMMAND_PREFIX}account balance`
 `{COMMAND_PREFIX}account create`
 `{COMMAND_PREFIX}tag add OFFER_ID TAG [TAG ...]`
-`{COMMAND_PREFIX}tag remove OFFER_ID TAG [TAG ...]`'''
+`{COMMAND_PREFIX}tag remove OFFER_ID TAG [TAG ...]`
+`{COMMAND_PREFIX}tag browse TAG [TAG ...] [--after OFFER_ID]`
+`{COMMAND_PREFIX}tag list`'''
 
     if is_admin:
         response += f'''
 `{COMMAND_PREFIX}help [full]`
-`{COMMAND_PREFIX}kill`'''
+`{COMMAND_PREFIX}kill`
+`{COMMAND_PREFIX}stats`'''
 
     response += f'''
 `{COMMAND_PREFIX}offer add TITLE PRICE DESCRIPTION [TAG TAG ...]`
 `{COMMAND_PREFIX}offer remove OFFER_ID [OFFER_ID OFFER_ID]`
-`{COMMAND_PREFIX}offer show @USER`
+`{COMMAND_PREFIX}offer show [@USER] [--page N | --after OFFER_ID]`
+`{COMMAND_PREFIX}offer search WORDS [--tag TAG] [--max-price N] [--page N]`
 `{COMMAND_PREFIX}transaction cancel TRANSACTION_ID [TRANSACTION_ID TRANSACTION_ID...]`
 `{COMMAND_PREFIX}transaction deny TRANSACTION_ID [TRANSACTION_ID TRANSACTION_ID...]`
 `{COMMAND_PREFIX}transaction request OFFER_ID [OFFER_ID OFFER_ID ...]`'''
 
     await message.reply(response)
-
-
-async def handle(client, message, args):
-    log.info(f'handle: arguments=({message, args})')
-    subcmd = None
-
-    if len(args) > 0:
-        subcmd = args[0]
-        args = args[1:]
-
-    user = message.author
-    is_admin = await role_check(client, user.id, 'admin')
-    is_member = await role_check(client, user.id, 'member')
-
-    if not is_member:
-        raise Exception('You are not a member.')
-
-
-    if subcmd and subcmd == 'full':
-        await subcmd_long(client, message, args, is_admin=is_admin)
-        return
-
-    else:
-        await subcmd_short(client, message, args, is_admin=is_admin)
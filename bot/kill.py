@@ -1,4 +1,4 @@
-from .utils import role_check
+from .commands import subcommand
 
 import shlex
 import logging
@@ -6,16 +6,8 @@ import logging
 log = logging.getLogger(__name__)
 
 
+@subcommand('kill', roles=('admin',), max_args=0, usage='kill')
 async def handle(client, message, args): # admin-only command
-    if len(args) > 0:
-        raise Exception(f'This command takes no arguments.')
-
-    user = message.author
-    is_admin = await role_check(client, user.id, 'admin')
-    is_member = await role_check(client, user.id, 'member')
-
-    if not is_admin:
-        raise Exception('You do not have permission to do that.')
-        log.warning(f'Non-admin user {user} tried to kill bot.')
+    log.warning(f'User {message.author} killed the bot.')
 
     quit()
@@ -0,0 +1,82 @@
+from .mutual_credit import async_credit_system as cs
+from .utils import tasks_running
+
+import asyncio
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+# seconds between ledger audits/checkpoints, 0 disables them
+LEDGER_CHECKPOINT_INTERVAL = float(os.getenv('LEDGER_CHECKPOINT_INTERVAL',
+                                             24 * 3600))
+# seconds between archive runs, 0 disables archiving
+TX_ARCHIVE_INTERVAL = float(os.getenv('TX_ARCHIVE_INTERVAL', 3600))
+# settled transactions older than this many seconds are archived
+TX_ARCHIVE_AGE = float(os.getenv('TX_ARCHIVE_AGE', 30 * 24 * 3600))
+# transactions moved per write transaction
+TX_ARCHIVE_BATCH_SIZE = int(os.getenv('TX_ARCHIVE_BATCH_SIZE', 500))
+
+
+class MaintenanceWorker:
+    ''' Runs periodic database jobs in the background
+
+    Each job is (name, coroutine function, interval in seconds). A job that
+    fails is logged and tried again at its next interval.
+    '''
+
+    def __init__(self):
+        self.jobs = []
+        if LEDGER_CHECKPOINT_INTERVAL > 0:
+            self.jobs.append(('ledger checkpoint', self.checkpoint_ledger,
+                              LEDGER_CHECKPOINT_INTERVAL))
+        if TX_ARCHIVE_INTERVAL > 0:
+            self.jobs.append(('transaction archive', self.archive_transactions,
+                              TX_ARCHIVE_INTERVAL))
+        self._tasks = []
+
+
+    def start(self):
+        if tasks_running(self._tasks):
+            return
+
+        self._tasks = [asyncio.ensure_future(self._run(*job))
+                       for job in self.jobs]
+
+
+    async def archive_transactions(self):
+        moved = 0
+
+        # one batch per write so commands aren't held up behind the job
+        while True:
+            count = await cs.archiveTransactions(TX_ARCHIVE_AGE,
+                                                 TX_ARCHIVE_BATCH_SIZE)
+            moved += count
+
+            if count < TX_ARCHIVE_BATCH_SIZE:
+                break
+
+        log.info(f'maintenance: archived {moved} transactions')
+
+
+    async def checkpoint_ledger(self):
+        checkpoints, problems = await cs.checkpointLedger()
+
+        for problem in problems:
+            log.error(f'maintenance: ledger mismatch for account '
+                      f'{problem.account_id} at entry {problem.entry_id}: '
+                      f'expected {problem.expected}, found {problem.found}')
+
+        log.info(f'maintenance: wrote {checkpoints} ledger checkpoints, '
+                 f'{len(problems)} problems')
+
+
+    async def _run(self, name, job, interval):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                await job()
+            except Exception as e:
+                log.exception(f'maintenance: {name} failed: {e}')
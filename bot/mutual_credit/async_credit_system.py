@@ -0,0 +1,137 @@
+# Awaitable facade over credit_system: every public credit_system function is
+# available here as a coroutine function with the same name and arguments.
+# Getters (get*, search*) run on a pool of reader threads and everything else
+# on a pool of writer threads, so sqlite3 never blocks the discord.py event
+# loop.
+# Writers for different accounts run in parallel, credit_system's account
+# locks serialize writers for the same account.
+# Each lane admits a bounded number of queued/running calls; once it is full
+# callers wait for a slot instead of piling up more work.
+from . import credit_system
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+READER_THREADS = int(os.getenv('DB_READER_THREADS', 4))
+WRITER_THREADS = int(os.getenv('DB_WRITER_THREADS', 4))
+READ_QUEUE_SIZE = int(os.getenv('DB_READ_QUEUE_SIZE', 256))
+WRITE_QUEUE_SIZE = int(os.getenv('DB_WRITE_QUEUE_SIZE', 64))
+
+
+class _Lane:
+
+    def __init__(self, name, workers, max_depth):
+        self.name = name
+        self.max_depth = max_depth
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix=f'cs-{name}')
+        self._slots = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'throttled': 0,
+            'depth': 0,
+            'max_depth': 0,
+            'wait_time': 0.0,
+            'run_time': 0.0,
+        }
+
+
+    async def run(self, func, *args, **kwargs):
+        # created lazily so it binds to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_depth)
+
+        stats = self._stats
+        stats['submitted'] += 1
+
+        if self._slots.locked():
+            stats['throttled'] += 1
+            log.debug(f'{self.name} queue full, waiting for a slot')
+
+        queued = time.perf_counter()
+
+        async with self._slots:
+            stats['depth'] += 1
+            stats['max_depth'] = max(stats['max_depth'], stats['depth'])
+
+            loop = asyncio.get_event_loop()
+            call = functools.partial(self._timed, queued, func, *args, **kwargs)
+
+            try:
+                result = await loop.run_in_executor(self._executor, call)
+            except Exception:
+                stats['failed'] += 1
+                raise
+            else:
+                stats['completed'] += 1
+            finally:
+                stats['depth'] -= 1
+
+        return result
+
+
+    def _timed(self, queued, func, *args, **kwargs):
+        started = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._stats['wait_time'] += started - queued
+                self._stats['run_time'] += finished - started
+
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, max_queue=self.max_depth)
+
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_reader = _Lane('reader', READER_THREADS, READ_QUEUE_SIZE)
+_writer = _Lane('writer', WRITER_THREADS, WRITE_QUEUE_SIZE)
+
+
+def _is_read(name):
+    return name.startswith(('get', 'search'))
+
+
+def queue_stats():
+    return {'reader': _reader.stats(), 'writer': _writer.stats()}
+
+
+def shutdown():
+    _writer.shutdown()
+    _reader.shutdown()
+
+
+def __getattr__(name):
+    func = getattr(credit_system, name)
+
+    if name.startswith('_') or not callable(func) or isinstance(func, type):
+        return func
+
+    lane = _reader if _is_read(name) else _writer
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await lane.run(func, *args, **kwargs)
+
+    # cache so later lookups skip __getattr__
+    globals()[name] = wrapper
+
+    return wrapper
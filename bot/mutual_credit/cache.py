@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    ''' Thread-safe bounded read-through cache, a size of 0 disables it
+
+    `invalidate()` bumps a generation counter so a value loaded before the
+    invalidation can't be stored after it by a slower reader thread.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+
+    def get_or_load(self, key, loader):
+        ''' Return the cached value for key, calling loader() on a miss
+
+        Values of None are returned but never cached.
+        '''
+        if self.size <= 0:
+            return loader()
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self._stats['hits'] += 1
+                return self._items[key]
+
+            self._stats['misses'] += 1
+            generation = self._generation
+
+        value = loader()
+
+        if value is None:
+            return value
+
+        with self._lock:
+            if generation != self._generation:
+                return value
+
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self._stats['evictions'] += 1
+
+        return value
+
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            self._items.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._items),
+                        max_size=self.size)
@@ -1,4 +1,6 @@
-from . import db
+from . import db, migrations
+from .cache import LRUCache
+from .locks import KeyedLocks
 from .errors import (
     AccountIDError,
     MaxBalanceError,
@@ -12,194 +14,604 @@ from .errors import (
 
 from discord.utils import get
 
+from collections import namedtuple
+import json
+import logging
 import os
+import re
 import sqlite3
 import sys
+import time
+
+log = logging.getLogger(__name__)
 
 
 #changes
 
 
+# account state as read by a single query
+AccountSnapshot = namedtuple('AccountSnapshot', [
+    'account_id',
+    'balance',
+    'min_balance',
+    'max_balance',
+    'pending_debits',
+    'pending_credits',
+    'available_balance',
+])
+
+
+# outcome of approving, denying or cancelling a transaction, with the state
+# of both accounts after the change
+SettlementResult = namedtuple('SettlementResult', [
+    'tx_id',
+    'status',
+    'buyer_id',
+    'seller_id',
+    'offer_id',
+    'price',
+    'buyer',
+    'seller',
+])
+
+
+# a ledger entry whose running balance doesn't follow from the entries
+# before it, or (entry_id None) an account balance that doesn't match the end
+# of its ledger
+LedgerProblem = namedtuple('LedgerProblem', [
+    'account_id',
+    'entry_id',
+    'expected',
+    'found',
+])
+
+
+# outcome of requesting an offer
+RequestResult = namedtuple('RequestResult', [
+    'tx_id',
+    'offer_id',
+    'seller_id',
+    'title',
+    'price',
+    'buyer',
+])
+
+
+# one entry of a bulk operation report, `error` is set if the item failed
+BatchItem = namedtuple('BatchItem', ['id', 'result', 'error'])
+
+
+# errors that fail a single item of a bulk operation rather than all of it
+BATCH_ITEM_ERRORS = (
+    AccountIDError,
+    MaxBalanceError,
+    MinBalanceError,
+    OfferIDError,
+    SelfTransactionError,
+    TransactionIDError,
+    TransactionStatusError,
+    UserPermissionError,
+)
+
+
 DFLT_CONFIG = {
     'min_balance': -1000,
     'max_balance': 1000,
 }
 
 
+# offers (with their categories) by ID, 0 disables the cache
+OFFER_CACHE_SIZE = int(os.getenv('OFFER_CACHE_SIZE', 1024))
+
+_offer_cache = LRUCache(OFFER_CACHE_SIZE)
+
+# Every mutating entry point holds the locks for the accounts it touches
+# for its whole read-check-write sequence, so commands for different
+# accounts can run in parallel threads while the same account is
+# serialized.
+_locks = KeyedLocks()
+
+
 def _init_db():
     with db.connect() as conn:
+        # baseline (version 0) tables, later changes are migrations
         db.init_accounts_table(conn)
         db.init_offers_table(conn)
         db.init_offer_categories_table(conn)
         db.init_transactions_table(conn)
+        migrations.migrate(conn)
 
+        log.info(f'SQLite settings for {db.DB_FILE}: {db.get_pragmas(conn)}')
 
-def addCategoryToOffer(member_id, offer_id, tag):
-    seller_id = getOfferSeller(offer_id)
-    Categories = getOfferCategories(offer_id)
 
-    if member_id != seller_id:
-        raise UserPermissionError('User tried to alter another members offer')
+# Approve, deny or cancel a pending transaction in a single write transaction.
+# The status and balance changes are guarded UPDATEs, so two concurrent
+# settlements of the same transaction (or against the same balance) can't
+# both succeed.
+def _settleTransaction(account_id, tx_id, status):
+    with db.transaction() as conn:
+        info = db.get_settlement_info(conn, tx_id)
 
-    if tag in categories:
-        return
+        if info is None:
+            raise TransactionIDError(f'Transaction with ID {tx_id} does not exist')
 
-    with db.connect() as conn:
-        db.create_offer_tag(conn, (offer_id, tag))
+        buyer_id, offer_id, tx_status, seller_id, price = info
 
+        if price is None:
+            raise OfferIDError(f'Transaction with ID {tx_id} has no matching offer')
 
-def addCategoriesToOffer(member_id, offer_id, categories):
-    seller_id = getOfferSeller(offer_id)
-    current_categories = getOfferCategories(offer_id)
+        owner_id = buyer_id if status == 'CANCELLED' else seller_id
+
+        if account_id != owner_id:
+            raise UserPermissionError(f'User with ID {account_id} tried to alter another members transaction')
+
+        if not db.close_transaction(conn, tx_id, status):
+            raise TransactionStatusError('Transaction status is not pending')
+
+        db.adjust_pending_totals(conn, buyer_id, -price, 0)
+        db.adjust_pending_totals(conn, seller_id, 0, -price)
+
+        if status == 'APPROVED':
+            if not db.credit_account_balance(conn, seller_id, price):
+                raise MaxBalanceError('Seller account too high for transaction')
+            if not db.debit_account_balance(conn, buyer_id, price):
+                raise MinBalanceError('Buyer account too low for transaction')
+
+        buyer = AccountSnapshot(*db.get_account_snapshot(conn, buyer_id))
+        seller = AccountSnapshot(*db.get_account_snapshot(conn, seller_id))
+
+        if status == 'APPROVED':
+            db.create_ledger_entries(conn, [
+                (seller_id, tx_id, 'CREDIT', price, seller.balance),
+                (buyer_id, tx_id, 'DEBIT', -price, buyer.balance)])
+
+        recipient_id = seller_id if status == 'CANCELLED' else buyer_id
+        db.create_outbox_messages(conn, [_notification(
+            recipient_id, status, tx_id=tx_id, actor_id=account_id,
+            available_balance=buyer.available_balance)])
 
-    if seller_id is None:
-        raise OfferIDError(f'An offer with ID {offer_id} does not exist.')
+    return SettlementResult(tx_id, status, buyer_id, seller_id, offer_id,
+                            price, buyer, seller)
 
-    if member_id != seller_id:
-        raise UserPermissionError('User tried to alter another members offer')
 
+# Bulk version of _settleTransaction. Everything the batch touches is loaded
+# up front, each item is validated in order against the in-memory state (so
+# earlier items in the batch affect later ones), and all changes are written
+# with executemany in one commit.
+def _settleTransactions(account_id, tx_ids, status):
+    report = []
+    settled = []
+    notifications = []
+    entries = []
+
+    with db.transaction() as conn:
+        infos = {row[0]: list(row[1:])
+                 for row in db.get_settlement_infos(conn, set(tx_ids))}
+        account_ids = {account_id}
+        for buyer_id, offer_id, tx_status, seller_id, price in infos.values():
+            account_ids.update((buyer_id, seller_id))
+        accounts = {row[0]: list(row)
+                    for row in db.get_account_snapshots(conn, account_ids)}
+        changed = set()
+
+        for tx_id in tx_ids:
+            try:
+                info = infos.get(tx_id)
+
+                if info is None:
+                    raise TransactionIDError(f'Transaction with ID {tx_id} does not exist')
+
+                buyer_id, offer_id, tx_status, seller_id, price = info
+
+                if price is None:
+                    raise OfferIDError(f'Transaction with ID {tx_id} has no matching offer')
+
+                owner_id = buyer_id if status == 'CANCELLED' else seller_id
+
+                if account_id != owner_id:
+                    raise UserPermissionError(f'User with ID {account_id} tried to alter another members transaction')
+
+                if tx_status != 'PENDING':
+                    raise TransactionStatusError('Transaction status is not pending')
+
+                buyer = accounts.get(buyer_id)
+                seller = accounts.get(seller_id)
+
+                if buyer is None or seller is None:
+                    raise AccountIDError(f'Transaction with ID {tx_id} has no matching account')
+
+                if status == 'APPROVED':
+                    if seller[1] + price > seller[3]:
+                        raise MaxBalanceError('Seller account too high for transaction')
+                    if buyer[1] - price < buyer[2]:
+                        raise MinBalanceError('Buyer account too low for transaction')
+
+                    seller[1] += price
+                    buyer[1] -= price
+                    entries.append((seller_id, tx_id, 'CREDIT', price,
+                                    seller[1]))
+                    entries.append((buyer_id, tx_id, 'DEBIT', -price,
+                                    buyer[1]))
+
+                buyer[4] -= price
+                seller[5] -= price
+                info[2] = status
+                changed.update((buyer_id, seller_id))
+                settled.append(tx_id)
+
+            except BATCH_ITEM_ERRORS as e:
+                report.append(BatchItem(tx_id, None, e))
+
+            else:
+                result = SettlementResult(tx_id, status, buyer_id, seller_id,
+                                          offer_id, price,
+                                          _snapshot(buyer), _snapshot(seller))
+                report.append(BatchItem(tx_id, result, None))
+
+                recipient_id = seller_id if status == 'CANCELLED' else buyer_id
+                notifications.append(_notification(
+                    recipient_id, status, tx_id=tx_id, actor_id=account_id,
+                    available_balance=result.buyer.available_balance))
+
+        db.close_transactions(conn, settled, status)
+        db.create_ledger_entries(conn, entries)
+        db.create_outbox_messages(conn, notifications)
+        db.update_account_totals(conn, [
+            (accounts[i][1], accounts[i][4], accounts[i][5], i)
+            for i in changed])
+
+    return report
+
+
+# outbox row for a DM to a member, written in the same DB transaction as the
+# change it reports and delivered by bot/outbox.py
+def _notification(recipient_id, event, **payload):
+    return (recipient_id, event, json.dumps(payload))
+
+
+def _getOffer(offer_id):
+    def load():
+        with db.connect() as conn:
+            return db.get_offer_with_categories(conn, offer_id)
+
+    offer = _offer_cache.get_or_load(offer_id, load)
+
+    if offer is None:
+        raise OfferIDError(f'No offer with ID {offer_id} exists.')
+
+    return offer
+
+
+# buyers with pending requests for an offer, read before taking locks
+def _offerBuyers(offer_id):
     with db.connect() as conn:
-        added = []
+        return {row[1] for row in db.get_pending_tx_for_offer(conn, offer_id)}
 
-        for tag in categories:
-            if tag in current_categories or tag in added:
-                continue
 
+# sellers of the existing offers, read before taking locks
+def _offerSellers(offer_ids):
+    with db.connect() as conn:
+        return {row[1] for row in db.get_offers_by_ids(conn, set(offer_ids))}
+
+
+# buyers and sellers of the existing transactions, read before taking locks
+def _transactionParties(tx_ids):
+    with db.connect() as conn:
+        rows = db.get_settlement_infos(conn, set(tx_ids))
+
+    return {row[1] for row in rows} | {row[4] for row in rows}
+
+
+# Replay an account's ledger from its last checkpoint and compare each
+# running balance, and the final one with `balance`. Returns the
+# LedgerProblems found and whether there were entries after the checkpoint.
+def _auditAccount(conn, account_id, balance):
+    checkpoint = db.get_last_ledger_checkpoint(conn, account_id)
+
+    if checkpoint is None:
+        return [LedgerProblem(account_id, None, None, balance)], False
+
+    problems = []
+    checkpoint_id, running, _ = checkpoint
+    entries = db.get_ledger_entries(conn, account_id, checkpoint_id)
+
+    for entry_id, tx_id, kind, amount, entry_balance, _ in entries:
+        running += amount
+
+        if entry_balance != running:
+            problems.append(LedgerProblem(account_id, entry_id, running,
+                                          entry_balance))
+            running = entry_balance
+
+    if running != balance:
+        problems.append(LedgerProblem(account_id, None, running, balance))
+
+    return problems, len(entries) > 0
+
+
+# AccountSnapshot from a mutable account row as loaded by the bulk operations
+def _snapshot(account):
+    account_id, balance, min_balance, max_balance, debits, credits = account[:6]
+    return AccountSnapshot(account_id, balance, min_balance, max_balance,
+                           debits, credits, balance - debits - min_balance)
+
+
+def addCategoryToOffer(member_id, offer_id, tag):
+    with _locks.hold(member_id):
+        seller_id = getOfferSeller(offer_id)
+        categories = getOfferCategories(offer_id)
+
+        if member_id != seller_id:
+            raise UserPermissionError('User tried to alter another members offer')
+
+        if tag in categories:
+            return
+
+        with db.connect() as conn:
             db.create_offer_tag(conn, (offer_id, tag))
-            added.append(tag)
+
+        _offer_cache.invalidate(offer_id)
+
+
+def addCategoriesToOffer(member_id, offer_id, categories):
+    with _locks.hold(member_id):
+        seller_id = getOfferSeller(offer_id)
+        current_categories = getOfferCategories(offer_id)
+
+        if seller_id is None:
+            raise OfferIDError(f'An offer with ID {offer_id} does not exist.')
+
+        if member_id != seller_id:
+            raise UserPermissionError('User tried to alter another members offer')
+
+        with db.connect() as conn:
+            added = []
+
+            for tag in categories:
+                if tag in current_categories or tag in added:
+                    continue
+
+                db.create_offer_tag(conn, (offer_id, tag))
+                added.append(tag)
+
+        _offer_cache.invalidate(offer_id)
 
 
 def approveTransaction(account_id, tx_id):
-    tx = getTransaction(tx_id)
+    with _locks.hold(account_id, *_transactionParties([tx_id])):
+        return _settleTransaction(account_id, tx_id, 'APPROVED')
 
-    if tx is None:
-        raise TransactionIDError(f'Transaction with ID {tx_id} does not exist')
 
-    buyer_id, offer_id, status = tx[1:4]
-    seller_id = getOfferSeller(offer_id)
+def approveTransactions(account_id, tx_ids):
+    with _locks.hold(account_id, *_transactionParties(tx_ids)):
+        return _settleTransactions(account_id, tx_ids, 'APPROVED')
 
-    if account_id != seller_id:
-        raise UserPermissionError(f'User with ID {account_id} tried to alter another members transaction')
 
-    buyer_balance = getAccountBalance(buyer_id)
-    buyer_min, buyer_max = getAccountRange(buyer_id)
-    seller_balance = getAccountBalance(seller_id)
-    seller_min, seller_max = getAccountRange(seller_id)
-    price = getOfferPrice(offer_id)
+# Move up to `limit` transactions that were settled more than `age` seconds
+# ago out of the live table. Returns how many were moved; they are still
+# found by ID. Settled transactions never change, so no account locks are
+# needed.
+def archiveTransactions(age, limit):
+    with db.transaction() as conn:
+        return db.archive_transactions(conn, int(time.time() - age), limit)
 
-    if status != 'PENDING':
-        raise TransactionStatusError('Transaction status is not pending')
-    if seller_balance + price > seller_max:
-        raise MaxBalanceError('Seller account too high for transaction')
-    if buyer_balance - price < buyer_min:
-        raise MinBalanceError('Buyer account too low for transaction')
 
+# Check every account (or those in `account_ids`) against its ledger, reading
+# only the entries since each account's last checkpoint. Returns a list of
+# LedgerProblem, empty if the ledger and balances agree.
+def auditLedger(account_ids=None):
     with db.connect() as conn:
-        db.update_transaction_status(conn, tx_id, 'APPROVED')
-        db.update_account_balance(conn, buyer_id, buyer_balance - price)
-        db.update_account_balance(conn, seller_id, seller_balance + price)
+        # one read transaction, so a settlement committed part way through
+        # isn't seen in the balances but not the ledger
+        if not conn.in_transaction:
+            conn.execute('BEGIN')
+
+        problems = []
+
+        for account_id, balance in db.get_account_balances(conn):
+            if account_ids is not None and account_id not in account_ids:
+                continue
+
+            problems.extend(_auditAccount(conn, account_id, balance)[0])
+
+        return problems
 
 
 def cancelTransaction(account_id, tx_id):
-    tx = getTransaction(tx_id)
+    with _locks.hold(account_id, *_transactionParties([tx_id])):
+        return _settleTransaction(account_id, tx_id, 'CANCELLED')
 
-    if tx is None:
-        raise TransactionIDError(f'Transaction with ID {tx_id} does not exist')
 
-    buyer_id, offer_id, status = tx[1:4]
+def cancelTransactions(account_id, tx_ids):
+    with _locks.hold(account_id, *_transactionParties(tx_ids)):
+        return _settleTransactions(account_id, tx_ids, 'CANCELLED')
 
-    if account_id != buyer_id:
-        raise UserPermissionError(f'User with ID {account_id} tried to alter another members transaction')
 
-    if status != 'PENDING':
-        raise TransactionStatusError('Transaction status is not pending')
+# Audit the ledger and write a CHECKPOINT entry with the current balance for
+# every account that has entries since its last one, so later audits and
+# balance lookups start from there. Accounts that fail the audit get no
+# checkpoint. Returns (number of checkpoints written, LedgerProblems).
+def checkpointLedger():
+    with _locks.hold_all():
+        problems = []
+        checkpoints = []
 
-    with db.connect() as conn:
-        db.update_transaction_status(conn, tx_id, 'CANCELLED')
+        with db.transaction() as conn:
+            for account_id, balance in db.get_account_balances(conn):
+                found, changed = _auditAccount(conn, account_id, balance)
+
+                if found:
+                    problems.extend(found)
+                elif changed:
+                    checkpoints.append((account_id, None, 'CHECKPOINT', 0,
+                                        balance))
+
+            db.create_ledger_entries(conn, checkpoints)
+
+        return len(checkpoints), problems
 
 
 def createAccount(account_id):
-    account = (account_id, 0, DFLT_CONFIG['max_balance'],
-                                                    DFLT_CONFIG['min_balance'])
+    with _locks.hold(account_id):
+        account = (account_id, 0, DFLT_CONFIG['max_balance'],
+                                                        DFLT_CONFIG['min_balance'])
 
-    try:
-        balance = getAccountBalance(account_id)
-    except AccountIDError as e: # account doesn't yet exist (expected)
-        with db.connect() as conn:
-            db.create_account(conn, account)
-    else:
-        raise AccountIDError(f'Account with ID {account_id} already exists.')
+        try:
+            balance = getAccountBalance(account_id)
+        except AccountIDError as e: # account doesn't yet exist (expected)
+            with db.transaction() as conn:
+                db.create_account(conn, account)
+                db.create_ledger_entries(conn, [
+                    (account_id, None, 'CHECKPOINT', 0, account[1])])
+        else:
+            raise AccountIDError(f'Account with ID {account_id} already exists.')
 
 
 def createOffer(seller_id, description, price, title):
-    offer = (seller_id, description, price, title)
+    with _locks.hold(seller_id):
+        offer = (seller_id, description, price, title)
 
-    with db.connect() as conn:
-        offer_id = db.create_offer(conn, offer)
+        with db.connect() as conn:
+            offer_id = db.create_offer(conn, offer)
 
-    return offer_id
+        return offer_id
 
 
-# Should use a "pending balance" rather than actual balance of buyer
 def createTransaction(buyer_id, offer_id):
-    with db.connect() as conn:
-        buyer_balance = getAvailableBalance(buyer_id)
-        buyer_min, buyer_max = getAccountRange(buyer_id)
-        price = getOfferPrice(offer_id)
-        seller_id =getOfferSeller(offer_id)
-        # TODO: check that offer exists
+    with _locks.hold(buyer_id, *_offerSellers([offer_id])):
+        with db.transaction() as conn:
+            available_balance = getAvailableBalance(buyer_id)
+            price = getOfferPrice(offer_id)
+            seller_id = getOfferSeller(offer_id)
+
+            if buyer_id == seller_id:
+                raise SelfTransactionError('Buyer ID must be different from seller ID')
+
+            if available_balance - price < 0:
+                raise MinBalanceError('Buyer balance too low for transaction')
+
+            tx_id = db.create_transaction(conn, (buyer_id, offer_id))
+            db.adjust_pending_totals(conn, buyer_id, price, 0)
+            db.adjust_pending_totals(conn, seller_id, 0, price)
+            db.create_outbox_messages(conn, [_notification(
+                seller_id, 'REQUESTED', tx_id=tx_id, actor_id=buyer_id,
+                title=getOfferTitle(offer_id))])
+
+        return tx_id
+
+
+# Bulk version of createTransaction, returns a BatchItem per offer ID with
+# a RequestResult for each request that was created.
+def createTransactions(buyer_id, offer_ids):
+    with _locks.hold(buyer_id, *_offerSellers(offer_ids)):
+        report = []
+        created = []
+
+        with db.transaction() as conn:
+            offers = {row[0]: row for row in db.get_offers_by_ids(conn, set(offer_ids))}
+            account_ids = {buyer_id} | {offer[1] for offer in offers.values()}
+            accounts = {row[0]: list(row)
+                        for row in db.get_account_snapshots(conn, account_ids)}
+
+            buyer = accounts.get(buyer_id)
+
+            if buyer is None:
+                raise AccountIDError(f'No account with ID {buyer_id} exists.')
 
-        if buyer_id == seller_id:
-            raise SelfTransactionError('Buyer ID must be different from seller ID')
+            for offer_id in offer_ids:
+                try:
+                    offer = offers.get(offer_id)
 
-        if buyer_balance - price < buyer_min:
-            raise MinBalanceError('Buyer balance too low for transaction')
+                    if offer is None:
+                        raise OfferIDError(f'No offer with ID {offer_id} exists.')
 
-        # TODO: seller_id in tx is technically unnecessary
-        tx_id = db.create_transaction(conn, (buyer_id, offer_id))
+                    offer_id, seller_id, price, title = offer
 
-    return tx_id
+                    if buyer_id == seller_id:
+                        raise SelfTransactionError('Buyer ID must be different from seller ID')
+
+                    if _snapshot(buyer).available_balance - price < 0:
+                        raise MinBalanceError('Buyer balance too low for transaction')
+
+                    buyer[4] += price
+                    if seller_id in accounts:
+                        accounts[seller_id][5] += price
+
+                except BATCH_ITEM_ERRORS as e:
+                    report.append(BatchItem(offer_id, None, e))
+
+                else:
+                    # filled in once the transaction IDs have been generated
+                    created.append((len(report), offer_id, seller_id, title,
+                                    price, _snapshot(buyer)))
+                    report.append(None)
+
+            tx_ids = db.create_transactions(conn, [(buyer_id, item[1])
+                                                   for item in created])
+            db.update_account_totals(conn, [
+                (account[1], account[4], account[5], account[0])
+                for account in accounts.values()])
+            db.create_outbox_messages(conn, [
+                _notification(seller_id, 'REQUESTED', tx_id=tx_id,
+                              actor_id=buyer_id, title=title)
+                for tx_id, (_, _, seller_id, title, _, _) in zip(tx_ids, created)])
+
+        for tx_id, (i, offer_id, *details) in zip(tx_ids, created):
+            report[i] = BatchItem(offer_id, RequestResult(tx_id, offer_id, *details),
+                                  None)
+
+        return report
 
 
 # delete could be dangerous, instead maybe have an 'enabled' flag
 def deleteAccount(account_id):
-    with db.connect() as conn:
-        with conn.cursor() as cur:
-            db.delete_account(cur, account_id)
+    with _locks.hold(account_id):
+        with db.connect() as conn:
+            db.delete_account(conn, account_id)
 
 
 # delete could be dangerous, instead maybe have an 'enabled' flag
 def deleteOffer(account_id, offer_id):
-    with db.connect() as conn:
-        seller_id = getOfferSeller(offer_id)
+    with _locks.hold(account_id, *_offerBuyers(offer_id)):
+        with db.connect() as conn:
+            seller_id = getOfferSeller(offer_id)
 
-    if seller_id is None:
-        raise OfferIDError(f'Offer with ID {offer_id} does not exist.')
+        if seller_id is None:
+            raise OfferIDError(f'Offer with ID {offer_id} does not exist.')
 
-    if account_id != seller_id:
-        raise UserPermissionError('User tried to delete another user\'s offer')
+        if account_id != seller_id:
+            raise UserPermissionError('User tried to delete another user\'s offer')
 
-    with db.connect() as conn:
-        db.delete_offer(conn, offer_id)
+        with db.transaction() as conn:
+            price = db.get_offer_price(conn, offer_id)
 
+            if price is None:
+                raise OfferIDError(f'Offer with ID {offer_id} does not exist.')
 
-def denyTransaction(account_id, tx_id):
-    tx = getTransaction(tx_id)
+            title = db.get_offer_title(conn, offer_id)
 
-    if tx is None:
-        raise TransactionIDError(f'Transaction with ID {tx_id} does not exist')
+            # pending requests for the offer can't be settled once it's gone
+            for tx_id, buyer_id in db.get_pending_tx_for_offer(conn, offer_id):
+                db.close_transaction(conn, tx_id, 'CANCELLED')
+                db.adjust_pending_totals(conn, buyer_id, -price, 0)
+                db.adjust_pending_totals(conn, seller_id, 0, -price)
+                db.create_outbox_messages(conn, [_notification(
+                    buyer_id, 'OFFER_REMOVED', tx_id=tx_id, actor_id=account_id,
+                    title=title)])
 
-    buyer_id, offer_id, status = tx[1:4]
-    seller_id = getOfferSeller(offer_id)
+            db.delete_offer(conn, offer_id)
 
-    if account_id != seller_id:
-        raise UserPermissionError(f'User with ID {account_id} tried to alter another members transaction')
+        _offer_cache.invalidate(offer_id)
 
-    if status != 'PENDING':
-        raise TransactionStatusError('Transaction status is not pending')
 
-    with db.connect() as conn:
-        db.update_transaction_status(conn, tx_id, 'DENIED')
+def denyTransaction(account_id, tx_id):
+    with _locks.hold(account_id, *_transactionParties([tx_id])):
+        return _settleTransaction(account_id, tx_id, 'DENIED')
+
+
+def denyTransactions(account_id, tx_ids):
+    with _locks.hold(account_id, *_transactionParties(tx_ids)):
+        return _settleTransactions(account_id, tx_ids, 'DENIED')
 
 
 def getAccountRange(account_id):
@@ -213,24 +625,15 @@ def getAccountRange(account_id):
 
 
 def getOfferCategories(offer_id):
-    with db.connect() as conn:
-        seller_id = getOfferSeller(offer_id)
-        categories = db.get_offer_categories(conn, offer_id)
+    return _getOffer(offer_id)[5]
 
-    if seller_id is None:
-        raise OfferIDError(f'Offer with ID {offer_id} does not exist')
 
-    return categories
+def getOfferCacheStats():
+    return _offer_cache.stats()
 
 
 def getOfferPrice(offer_id):
-    with db.connect() as conn:
-        price = db.get_offer_price(conn, offer_id)
-
-    if price is None:
-        raise OfferIDError(f'Offer with ID {offer_id} does not exist.')
-
-    return price
+    return _getOffer(offer_id)[3]
 
 
 def getAccountBalance(account_id):
@@ -243,41 +646,79 @@ def getAccountBalance(account_id):
     return balance
 
 
+# balance as of a unix timestamp, None if that is before the account's
+# ledger starts
+def getBalanceAt(account_id, timestamp):
+    with db.connect() as conn:
+        return db.get_ledger_balance_at(conn, account_id, int(timestamp))
+
+
 # available balance is the the amount of credit left to use
 # available_balance = account_balance - sum(pending_debits) - min_balance
 def getAvailableBalance(account_id):
-    min_balance, max_balance = getAccountRange(account_id)
-    balance = getAccountBalance(account_id)
-    pending_debits = getTotalPendingDebits(account_id)
+    return getAccountSnapshot(account_id).available_balance
+
+
+def getAccountSnapshot(account_id):
+    with db.connect() as conn:
+        row = db.get_account_snapshot(conn, account_id)
+
+    if row is None:
+        raise AccountIDError(f'No account with ID {account_id} exists.')
+
+    return AccountSnapshot(*row)
+
+
+# Offers that have every tag in `tags` as rows with a tuple of their
+# categories as the last column, ordered by offer ID. Pass the last offer
+# ID seen as `after` for the next page.
+def getOffersByTags(tags, after=None, limit=None):
+    tags = list(dict.fromkeys(tags))
 
-    return balance - pending_debits - min_balance
+    with db.connect() as conn:
+        counts = dict(db.get_tag_counts(conn, tags))
+
+        if len(counts) < len(tags):
+            return []
 
+        # walk the offers of the rarest tag and check the others per offer
+        tags.sort(key=counts.get)
+        return db.get_offers_by_tags(conn, tags, after, limit)
 
-def getOffers(seller_id):
+
+def getOffers(seller_id, after=None, limit=None):
     with db.connect() as conn:
-        offers = db.get_offers_by_seller(conn, seller_id)
+        offers = db.get_offers_by_seller(conn, seller_id, after, limit)
 
     return offers
 
 
-def getOfferSeller(offer_id):
+# offer rows with a tuple of their categories as the last column, ordered
+# by offer ID. Pass the last offer ID seen as `after` for the next page.
+def getOffersWithCategories(seller_id, after=None, limit=None, offset=0):
     with db.connect() as conn:
-        seller_id = db.get_offer_seller(conn, offer_id)
+        offers = db.get_offers_with_categories(conn, seller_id, after, limit,
+                                               offset)
 
-    if seller_id is None:
-        raise OfferIDError(f'No offer with ID {offer_id} exists.')
+    return offers
 
-    return seller_id
+
+def getOfferSeller(offer_id):
+    return _getOffer(offer_id)[1]
+
+
+def getLockStats():
+    return _locks.stats()
 
 
 def getOfferTitle(offer_id):
-    with db.connect() as conn:
-        title = db.get_offer_title(conn, offer_id)
+    return _getOffer(offer_id)[4]
 
-    if title is None:
-        raise OfferIDError(f'No offer with ID {offer_id} exists.')
 
-    return title
+# (tag, number of offers) for the `limit` most used tags
+def getTopTags(limit):
+    with db.connect() as conn:
+        return db.get_top_tags(conn, limit)
 
 
 # returns sum of price of pending sales
@@ -296,6 +737,19 @@ def getTotalPendingDebits(account_id):
     return debits
 
 
+# undelivered outbox messages that are due for a (re)try, as rows of
+# (id, recipient_id, event, payload dict, attempts)
+def getDueNotifications(max_attempts, limit):
+    with db.connect() as conn:
+        rows = db.get_due_outbox_messages(conn, max_attempts, limit)
+
+    return [(*row[:3], json.loads(row[3]), row[4]) for row in rows]
+
+
+def getPoolStats():
+    return db.pool_stats()
+
+
 def getTransaction(tx_id):
     with db.connect() as conn:
         tx = db.get_transaction(conn, tx_id)
@@ -320,56 +774,111 @@ def getTransactionSeller(tx_id):
     return seller_id
 
 
-def getPendingBuys(account_id):
+# pending transactions are ordered by (start_timestamp, id), pass that pair
+# from the last row seen as `after` for the next page
+def getPendingBuys(account_id, after=None, limit=None):
     with db.connect() as conn:
-        buys = db.get_pending_tx_for_buyer(conn, account_id)
+        buys = db.get_pending_tx_for_buyer(conn, account_id, after, limit)
     return buys
 
 
-def getPendingSales(accountId):
+def getPendingSales(accountId, after=None, limit=None):
     with db.connect() as conn:
-        sales = db.get_pending_tx_for_seller(conn, accountId)
+        sales = db.get_pending_tx_for_seller(conn, accountId, after, limit)
     return sales
 
 
-def removeCategoryFromOffer(member_id, offer_id, tag):
+def markNotificationsDelivered(message_ids):
     with db.connect() as conn:
-        seller_id = getOfferSeller(offer_id)
-        current_categories = getOfferCategories(offer_id)
+        db.mark_outbox_delivered(conn, message_ids)
+
+
+# Rebuild the pending debit/credit counters from the transactions table.
+# Returns (account_id, old_debits, old_credits, debits, credits) for every
+# account whose counters had drifted.
+def recomputePendingTotals():
+    with _locks.hold_all():
+        drifted = []
+
+        with db.transaction() as conn:
+            for row in db.compute_pending_totals(conn):
+                account_id, old_debits, old_credits, debits, credits = row
 
-    if seller_id is None:
-        raise OfferIDError(f'Offer with ID {offer_id} does not exist.')
+                if (old_debits, old_credits) == (debits, credits):
+                    continue
 
-    if member_id != seller_id:
-        raise UserPermissionError(f'User tried to alter offer of another user.')
+                db.update_pending_totals(conn, account_id, debits, credits)
+                drifted.append(row)
 
-    if tag not in current_categories:
-        return
+        return drifted
 
+
+# rows of (next_attempt_timestamp, message_id)
+def rescheduleNotifications(rows):
     with db.connect() as conn:
-        db.delete_offer_tag(conn, offer_id, tag)
+        db.reschedule_outbox_messages(conn, rows)
+
+
+def removeCategoryFromOffer(member_id, offer_id, tag):
+    with _locks.hold(member_id):
+        with db.connect() as conn:
+            seller_id = getOfferSeller(offer_id)
+            current_categories = getOfferCategories(offer_id)
+
+        if seller_id is None:
+            raise OfferIDError(f'Offer with ID {offer_id} does not exist.')
+
+        if member_id != seller_id:
+            raise UserPermissionError(f'User tried to alter offer of another user.')
+
+        if tag not in current_categories:
+            return
+
+        with db.connect() as conn:
+            db.delete_offer_tag(conn, offer_id, tag)
+
+        _offer_cache.invalidate(offer_id)
 
 
 def removeCategoriesFromOffer(member_id, offer_id, categories):
-    seller_id = getOfferSeller(offer_id)
-    current_categories = getOfferCategories(offer_id)
+    with _locks.hold(member_id):
+        seller_id = getOfferSeller(offer_id)
+        current_categories = getOfferCategories(offer_id)
 
-    if seller_id is None:
-        raise OfferIDError(f'Offer with ID {offer_id} does not exist')
+        if seller_id is None:
+            raise OfferIDError(f'Offer with ID {offer_id} does not exist')
 
-    if member_id != seller_id:
-        raise UserPermissionError('User tried to alter another members offer')
+        if member_id != seller_id:
+            raise UserPermissionError('User tried to alter another members offer')
 
 
-    with db.connect() as conn:
-        removed = []
+        with db.connect() as conn:
+            removed = []
 
-        for tag in categories:
-            if tag not in current_categories:
-                continue
+            for tag in categories:
+                if tag not in current_categories:
+                    continue
 
-            db.delete_offer_tag(conn, offer_id, tag)
-            removed.append(tag)
+                db.delete_offer_tag(conn, offer_id, tag)
+                removed.append(tag)
+
+        _offer_cache.invalidate(offer_id)
+
+
+# Offers matching search text, best match first, as rows with a tuple of
+# their categories as the last column. Every word has to match the start of
+# a word in the title or description; punctuation is ignored, so the text
+# can't be read as FTS5 query syntax.
+def searchOffers(text, tag=None, max_price=None, limit=None, offset=0):
+    words = re.findall(r'\w+', text)
+
+    if not words:
+        return []
+
+    match = ' '.join(f'"{word}"*' for word in words)
+
+    with db.connect() as conn:
+        return db.search_offers(conn, match, tag, max_price, limit, offset)
 
 
 
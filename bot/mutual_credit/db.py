@@ -1,10 +1,79 @@
+from contextlib import contextmanager
+import os
 import sqlite3
 from sqlite3 import Error
+import threading
 import time
-import uuid
 
 
-DB_FILE = 'credit_system.db'
+DB_FILE = os.getenv('DB_FILE', 'credit_system.db')
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+
+# applied to every new connection. WAL lets readers run alongside the
+# writer, and with synchronous=NORMAL a commit no longer fsyncs (a power
+# loss can drop the last commits, but can't corrupt the database).
+PRAGMAS = {
+    'journal_mode': os.getenv('DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('DB_MMAP_SIZE', 64 * 1024 * 1024)),
+    # negative sizes are in KiB rather than pages
+    'cache_size': int(os.getenv('DB_CACHE_SIZE', -16000)),
+    'temp_store': os.getenv('DB_TEMP_STORE', 'MEMORY'),
+    'busy_timeout': int(os.getenv('DB_BUSY_TIMEOUT', 5000)),
+}
+
+# Settled transactions are moved out of `transactions` once they are old
+# enough (see archive_transactions) into transactions_history, kept in
+# DB_HISTORY_FILE if it is set and in the main database otherwise. Lookups
+# by ID read the all_transactions view over both tables. Choose the file
+# before the first archive run; rows already moved aren't carried over.
+HISTORY_FILE = os.getenv('DB_HISTORY_FILE') or None
+HISTORY_SCHEMA = 'history' if HISTORY_FILE else 'main'
+
+# values PRAGMAs can't take as parameters, so only these are accepted
+PRAGMA_CHOICES = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY'},
+}
+
+
+def _apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        if name in PRAGMA_CHOICES:
+            value = str(value).upper()
+            if value not in PRAGMA_CHOICES[name]:
+                raise ValueError(f'Invalid value {value} for PRAGMA {name}')
+        else:
+            value = int(value)
+
+        conn.execute(f'PRAGMA {name}={value}')
+
+
+# Attach the history database, apply `pragmas` and create the per-connection
+# views. The attach comes first so the PRAGMAs cover the history file too,
+# and the views last as setting temp_store drops everything in temp.
+def init_connection(conn, pragmas=None):
+    if HISTORY_FILE:
+        conn.execute('ATTACH DATABASE ? AS history', (HISTORY_FILE,))
+
+    if pragmas:
+        _apply_pragmas(conn, pragmas)
+
+    init_transactions_history_table(conn)
+    init_views(conn)
+
+
+# temporary, so the view can span the main and history databases
+def init_views(conn):
+    conn.execute(f'''CREATE TEMP VIEW IF NOT EXISTS all_transactions AS
+                     SELECT id, buyer_id, offer_id, status, start_timestamp,
+                            end_timestamp
+                     FROM main.transactions
+                     UNION ALL
+                     SELECT id, buyer_id, offer_id, status, start_timestamp,
+                            end_timestamp
+                     FROM {HISTORY_SCHEMA}.transactions_history''')
 
 
 def _create_table(conn, sql):
@@ -18,8 +87,200 @@ def _create_table(conn, sql):
         raise Exception('Failed to create database cursorection')
 
 
+class ConnectionPool:
+    ''' Fixed-size pool of sqlite3 connections
+
+    A thread that is already holding a connection gets the same one back
+    from nested `connection()` calls, and only the outermost call commits
+    (or rolls back) and returns the connection to the pool.
+    '''
+
+    def __init__(self, db_file, size=POOL_SIZE, pragmas=PRAGMAS):
+        self.db_file = db_file
+        self.size = size
+        self.pragmas = pragmas
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'nested': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'discarded': 0,
+        }
+
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        init_connection(conn, self.pragmas)
+        self._count('created')
+        return conn
+
+
+    def _healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except Error:
+            return False
+        return True
+
+
+    def _checkout(self):
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            self._slots.acquire()
+
+        self._count('checkouts')
+
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+
+            if conn is None:
+                return self._open()
+
+            if self._healthy(conn):
+                self._count('reused')
+                return conn
+
+            self._count('discarded')
+            conn.close()
+
+
+    def _checkin(self, conn):
+        if conn.in_transaction or not self._healthy(conn):
+            self._count('discarded')
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.append(conn)
+
+        self._slots.release()
+
+
+    @contextmanager
+    def connection(self, immediate=False):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is not None:
+            self._count('nested')
+            if immediate and not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+
+        try:
+            with conn:
+                # take the write lock up front so reads made inside the
+                # transaction can't be invalidated by another writer
+                if immediate:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+
+        stats['size'] = self.size
+        return stats
+
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn in idle:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_FILE)
+
+    return _pool
+
+
+# joins tags in group_concat, a control character so it can't be in a tag
+TAG_SEPARATOR = '\x1f'
+TAG_SEPARATOR_SQL = 'char(31)'
+
+
+def _with_tags(row):
+    tags = row[-1]
+    return (*row[:-1], tuple(tags.split(TAG_SEPARATOR)) if tags else ())
+
+
+# keyset pagination helpers: the SQL for rows after the previous page and
+# the matching parameters (a LIMIT of -1 means no limit in SQLite)
+def _after_id(column, after):
+    if after is None: return ''
+    return f'AND {column} > ?'
+
+
+def _after_start(timestamp_column, id_column, after):
+    if after is None: return ''
+    return f'AND ({timestamp_column}, {id_column}) > (?, ?)'
+
+
+def _keyset_params(params, after, limit):
+    if after is not None:
+        params = (*params, *(after if isinstance(after, tuple) else (after,)))
+    return (*params, -1 if limit is None else limit)
+
+
+# offers (by `column`) that also have each of `tags`
+def _has_tags(column, tags):
+    return ' '.join(f'''AND EXISTS (SELECT 1
+                                  FROM offer_categories as x
+                                  WHERE x.offer_id == {column}
+                                    AND x.tag=?)''' for _ in tags)
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
 def connect():
-    return sqlite3.connect(DB_FILE)
+    return get_pool().connection()
+
+
+def transaction():
+    return get_pool().connection(immediate=True)
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+# the settings as SQLite reports them, e.g. journal_mode falls back to
+# DELETE where WAL isn't supported
+def get_pragmas(conn):
+    return {name: conn.execute(f'PRAGMA {name}').fetchone()[0]
+            for name in PRAGMAS}
 
 
 def init_accounts_table(conn):
@@ -64,35 +325,174 @@ def init_transactions_table(conn):
                             );''')
 
 
+def init_transactions_history_table(conn):
+    _create_table(conn, f''' CREATE TABLE IF NOT EXISTS
+                                {HISTORY_SCHEMA}.transactions_history (
+                                id integer PRIMARY KEY,
+                                buyer_id int NOT NULL,
+                                offer_id integer NOT NULL,
+                                status text NOT NULL,
+                                start_timestamp int NOT NULL,
+                                end_timestamp int
+                            ); ''')
+
+
+def adjust_pending_totals(conn, account_id, debits, credits):
+    sql = '''UPDATE accounts
+             SET pending_debits=pending_debits + ?,
+                 pending_credits=pending_credits + ?
+             WHERE id=?'''
+    conn.execute(sql, (debits, credits, account_id))
+
+
+# Move up to `limit` settled transactions that ended before `cutoff` to
+# transactions_history, oldest first, and return how many were moved. Rows
+# are copied with INSERT OR IGNORE before they are deleted, so a move cut
+# short between the two files (which commit separately in WAL mode) is
+# finished by the next run.
+def archive_transactions(conn, cutoff, limit):
+    sql = '''SELECT id
+             FROM transactions
+             WHERE status!="PENDING"
+               AND coalesce(end_timestamp, start_timestamp) < ?
+             ORDER BY coalesce(end_timestamp, start_timestamp)
+             LIMIT ?'''
+    tx_ids = [row[0] for row in conn.execute(sql, (cutoff, limit)).fetchall()]
+    if len(tx_ids) == 0: return 0
+
+    sql = f'''INSERT OR IGNORE INTO {HISTORY_SCHEMA}.transactions_history(id,
+                 buyer_id, offer_id, status, start_timestamp, end_timestamp)
+              SELECT id, buyer_id, offer_id, status, start_timestamp,
+                     end_timestamp
+              FROM transactions
+              WHERE id IN ({_placeholders(tx_ids)})'''
+    conn.execute(sql, tx_ids)
+    sql = f'''DELETE FROM transactions
+              WHERE id IN ({_placeholders(tx_ids)})'''
+    conn.execute(sql, tx_ids)
+
+    return len(tx_ids)
+
+
+# only closes the transaction if it is still pending, returns rows changed
+def close_transaction(conn, tx_id, status):
+    sql = '''UPDATE transactions
+             SET status=?, end_timestamp=?
+             WHERE id=? AND status="PENDING"'''
+    cur = conn.execute(sql, (status, int(time.time()), tx_id))
+    return cur.rowcount
+
+
+def close_transactions(conn, tx_ids, status):
+    sql = '''UPDATE transactions
+             SET status=?, end_timestamp=?
+             WHERE id=? AND status="PENDING"'''
+    end_timestamp = int(time.time())
+    conn.executemany(sql, [(status, end_timestamp, tx_id) for tx_id in tx_ids])
+
+
+# pending totals as summed from transactions, for checking the counters
+def compute_pending_totals(conn):
+    sql = '''SELECT a.id, a.pending_debits, a.pending_credits,
+                    coalesce((SELECT sum(o.price)
+                              FROM transactions as t
+                              JOIN offers as o
+                              ON (t.offer_id == o.id)
+                              WHERE t.buyer_id=a.id
+                                AND t.status="PENDING"), 0),
+                    coalesce((SELECT sum(o.price)
+                              FROM offers as o
+                              JOIN transactions as t
+                              ON (t.offer_id == o.id)
+                              WHERE o.seller_id=a.id
+                                AND t.status="PENDING"), 0)
+             FROM accounts as a'''
+    rows = conn.execute(sql).fetchall()
+    return rows
+
+
 def create_account(conn, account):
     sql = '''INSERT INTO accounts(id, balance, max_balance, min_balance)
              VALUES(?, ?, ?, ?)'''
     conn.execute(sql, account)
 
 
+# Rows of (account_id, tx_id, kind, amount, balance after the entry). Kind
+# is CREDIT or DEBIT for a settled transaction (two rows per transaction,
+# amounts summing to zero) or CHECKPOINT for an audited balance (amount 0).
+# Entries are only ever appended.
+def create_ledger_entries(conn, entries):
+    now = int(time.time())
+    sql = '''INSERT INTO ledger_entries(account_id, tx_id, kind, amount,
+                balance, timestamp)
+             VALUES(?, ?, ?, ?, ?, ?)'''
+    conn.executemany(sql, [(*entry, now) for entry in entries])
+
+
 def create_offer(conn, offer):
-    offer_id = uuid.uuid4().hex
-    sql = '''INSERT INTO offers(id, seller_id, description, price, title)
-             VALUES(?, ?, ?, ?, ?)'''
-    conn.execute(sql, (offer_id, *offer))
+    sql = '''INSERT INTO offers(seller_id, description, price, title)
+             VALUES(?, ?, ?, ?)'''
+    cur = conn.execute(sql, offer)
 
-    return offer_id
+    return cur.lastrowid
 
 
 def create_offer_tag(conn, offer_tag):
     sql = '''INSERT INTO offer_categories(offer_id, tag)
              VALUES(?, ?)'''
     conn.execute(sql, offer_tag)
+    sql = '''INSERT INTO tag_counts(tag, count)
+             VALUES(?, 1)
+             ON CONFLICT(tag) DO UPDATE SET count=count + 1'''
+    conn.execute(sql, (offer_tag[1],))
+
+
+# rows of (recipient_id, event, payload)
+def create_outbox_messages(conn, messages):
+    now = int(time.time())
+    sql = '''INSERT INTO outbox(recipient_id, event, payload,
+                created_timestamp, next_attempt_timestamp)
+             VALUES(?, ?, ?, ?, ?)'''
+    conn.executemany(sql, [(*message, now, now) for message in messages])
 
 
 def create_transaction(conn, tx):
-    tx = (uuid.uuid4().hex, *tx, "PENDING", int(time.time()), None)
-    sql = '''INSERT INTO transactions(id, buyer_id, offer_id, status,
+    tx = (*tx, "PENDING", int(time.time()), None)
+    sql = '''INSERT INTO transactions(buyer_id, offer_id, status,
                 start_timestamp, end_timestamp)
-             VALUES(?, ?, ?, ?, ?, ?)'''
-    conn.execute(sql, tx)
+             VALUES(?, ?, ?, ?, ?)'''
+    cur = conn.execute(sql, tx)
+
+    return cur.lastrowid
 
-    return tx[0]
+
+# one INSERT per row rather than executemany, which can't report the keys
+def create_transactions(conn, txs):
+    start_timestamp = int(time.time())
+    sql = '''INSERT INTO transactions(buyer_id, offer_id, status,
+                start_timestamp, end_timestamp)
+             VALUES(?, ?, ?, ?, ?)'''
+
+    return [conn.execute(sql, (*tx, "PENDING", start_timestamp, None)).lastrowid
+            for tx in txs]
+
+
+# only credits if the new balance stays within range, returns rows changed
+def credit_account_balance(conn, account_id, amount):
+    sql = '''UPDATE accounts
+             SET balance=balance + ?
+             WHERE id=? AND balance + ? <= max_balance'''
+    cur = conn.execute(sql, (amount, account_id, amount))
+    return cur.rowcount
+
+
+# only debits if the new balance stays within range, returns rows changed
+def debit_account_balance(conn, account_id, amount):
+    sql = '''UPDATE accounts
+             SET balance=balance - ?
+             WHERE id=? AND balance - ? >= min_balance'''
+    cur = conn.execute(sql, (amount, account_id, amount))
+    return cur.rowcount
 
 
 def delete_account(cursor, account_id):
@@ -101,7 +501,11 @@ def delete_account(cursor, account_id):
     cursor.execute(sql, (account_id,))
 
 
+# the offer's tags go with it
 def delete_offer(conn, offer_id):
+    for tag in get_offer_categories(conn, offer_id):
+        delete_offer_tag(conn, offer_id, tag)
+
     sql = '''DELETE FROM offers
              WHERE id=?'''
     conn.execute(sql, (offer_id,))
@@ -110,7 +514,16 @@ def delete_offer(conn, offer_id):
 def delete_offer_tag(conn, offer_id, tag):
     sql = '''DELETE FROM offer_categories
              WHERE offer_id=? AND tag=?'''
-    conn.execute(sql, (offer_id, tag))
+    cur = conn.execute(sql, (offer_id, tag))
+    if cur.rowcount == 0: return
+
+    sql = '''UPDATE tag_counts
+             SET count=count - 1
+             WHERE tag=?'''
+    conn.execute(sql, (tag,))
+    sql = '''DELETE FROM tag_counts
+             WHERE tag=? AND count <= 0'''
+    conn.execute(sql, (tag,))
 
 
 def get_account_balance(conn, account_id):
@@ -122,6 +535,14 @@ def get_account_balance(conn, account_id):
     return None
 
 
+# (id, balance) for every account
+def get_account_balances(conn):
+    sql = '''SELECT id, balance
+             FROM accounts'''
+    rows = conn.execute(sql).fetchall()
+    return rows
+
+
 # get min,max balance range for account
 def get_account_range(conn, account_id):
     sql = '''SELECT min_balance, max_balance
@@ -131,15 +552,133 @@ def get_account_range(conn, account_id):
     return row
 
 
-def get_offers_by_seller(cursor, seller_id):
-    sql = '''SELECT *
-             FROM offers
-             WHERE seller_id=?'''
-    rows = cursor.execute(sql, (seller_id,)).fetchall()
+# balance, range and pending totals for an account in one read
+def get_account_snapshot(conn, account_id):
+    sql = '''SELECT id, balance, min_balance, max_balance, pending_debits,
+                    pending_credits,
+                    balance - pending_debits - min_balance
+             FROM accounts
+             WHERE id=?'''
+    row = conn.execute(sql, (account_id,)).fetchone()
+    return row
+
+
+def get_account_snapshots(conn, account_ids):
+    account_ids = list(account_ids)
+    sql = f'''SELECT id, balance, min_balance, max_balance, pending_debits,
+                     pending_credits,
+                     balance - pending_debits - min_balance
+              FROM accounts
+              WHERE id IN ({_placeholders(account_ids)})'''
+    rows = conn.execute(sql, account_ids).fetchall()
+    return rows
+
+
+# undelivered messages that are due, oldest first
+def get_due_outbox_messages(conn, max_attempts, limit):
+    sql = '''SELECT id, recipient_id, event, payload, attempts
+             FROM outbox
+             WHERE delivered_timestamp IS NULL
+               AND next_attempt_timestamp <= ?
+               AND attempts < ?
+             ORDER BY next_attempt_timestamp, id
+             LIMIT ?'''
+    rows = conn.execute(sql, (int(time.time()), max_attempts, limit)).fetchall()
+    return rows
+
+
+# An account's balance as of `timestamp`, from the last entry at or before
+# it. Only the entries between the checkpoints either side of `timestamp`
+# are read. None if the ledger has no checkpoint for the account by then.
+def get_ledger_balance_at(conn, account_id, timestamp):
+    sql = '''SELECT e.balance
+             FROM ledger_entries as e
+             WHERE e.account_id=? AND e.timestamp<=?
+               AND e.id >= (SELECT c.id
+                            FROM ledger_entries as c
+                            WHERE c.account_id=? AND c.kind="CHECKPOINT"
+                              AND c.timestamp<=?
+                            ORDER BY c.timestamp DESC, c.id DESC
+                            LIMIT 1)
+               AND e.id < coalesce((SELECT c.id
+                                    FROM ledger_entries as c
+                                    WHERE c.account_id=? AND c.kind="CHECKPOINT"
+                                      AND c.timestamp>?
+                                    ORDER BY c.timestamp, c.id
+                                    LIMIT 1), 9223372036854775807)
+             ORDER BY e.id DESC
+             LIMIT 1'''
+    row = conn.execute(sql, (account_id, timestamp) * 3).fetchone()
+    if row: return row[0]
+    return row
+
+
+# id, tx_id, kind, amount, balance, timestamp of an account's entries after
+# entry `after`, oldest first
+def get_ledger_entries(conn, account_id, after):
+    sql = '''SELECT id, tx_id, kind, amount, balance, timestamp
+             FROM ledger_entries
+             WHERE account_id=? AND id > ?
+             ORDER BY id'''
+    rows = conn.execute(sql, (account_id, after)).fetchall()
+    return rows
+
+
+# id, balance, timestamp of an account's latest checkpoint
+def get_last_ledger_checkpoint(conn, account_id):
+    sql = '''SELECT id, balance, timestamp
+             FROM ledger_entries
+             WHERE account_id=? AND kind="CHECKPOINT"
+             ORDER BY id DESC
+             LIMIT 1'''
+    row = conn.execute(sql, (account_id,)).fetchone()
+    return row
+
+
+# Offer rows with their tags appended as a tuple for the offers that have
+# every tag in `tags`, ordered by ID. The rows are found from the index
+# entries of tags[0], so callers pass the rarest tag first; the others are
+# checked per offer. `after` is the last offer ID of the previous page.
+def get_offers_by_tags(conn, tags, after=None, limit=None):
+    sql = f'''SELECT o.*, (SELECT group_concat(c.tag, {TAG_SEPARATOR_SQL})
+                           FROM offer_categories as c
+                           WHERE c.offer_id == o.id)
+              FROM offer_categories as t
+              JOIN offers as o
+              ON (o.id == t.offer_id)
+              WHERE t.tag=? {_after_id('t.offer_id', after)}
+                {_has_tags('t.offer_id', tags[1:])}
+              ORDER BY t.offer_id
+              LIMIT ?'''
+    params = (tags[0], *(() if after is None else (after,)), *tags[1:],
+              -1 if limit is None else limit)
+    rows = conn.execute(sql, params).fetchall()
+    return [_with_tags(row) for row in rows]
+
+
+# offers ordered by ID, `after` is the last offer ID of the previous page
+def get_offers_by_seller(cursor, seller_id, after=None, limit=None):
+    sql = f'''SELECT *
+              FROM offers
+              WHERE seller_id=? {_after_id('id', after)}
+              ORDER BY id
+              LIMIT ?'''
+    params = _keyset_params((seller_id,), after, limit)
+    rows = cursor.execute(sql, params).fetchall()
     if len(rows) == 0: return None
     return rows
 
 
+# id, seller_id, price, title for each existing offer
+def get_offers_by_ids(conn, offer_ids):
+    offer_ids = list(offer_ids)
+    sql = f'''SELECT id, seller_id, price, title
+              FROM offers
+              WHERE id IN ({_placeholders(offer_ids)})'''
+    rows = conn.execute(sql, offer_ids).fetchall()
+    return rows
+
+
 def get_offer_categories(cursor, offer_id):
     sql = '''SELECT tag
              FROM offer_categories
@@ -149,6 +688,37 @@ def get_offer_categories(cursor, offer_id):
     return rows
 
 
+# offer row with its tags appended as a tuple, in one query
+def get_offer_with_categories(conn, offer_id):
+    sql = f'''SELECT o.*, group_concat(c.tag, {TAG_SEPARATOR_SQL})
+              FROM offers as o
+              LEFT JOIN offer_categories as c
+              ON (c.offer_id == o.id)
+              WHERE o.id=?
+              GROUP BY o.id'''
+    row = conn.execute(sql, (offer_id,)).fetchone()
+    if row: return _with_tags(row)
+    return row
+
+
+# offer rows for a seller with their tags appended as a tuple, in one query,
+# ordered by ID. `after` is the last offer ID of the previous page, `offset`
+# skips rows for numbered pages.
+def get_offers_with_categories(conn, seller_id, after=None, limit=None,
+                               offset=0):
+    sql = f'''SELECT o.*, group_concat(c.tag, {TAG_SEPARATOR_SQL})
+              FROM offers as o
+              LEFT JOIN offer_categories as c
+              ON (c.offer_id == o.id)
+              WHERE o.seller_id=? {_after_id('o.id', after)}
+              GROUP BY o.id
+              ORDER BY o.id
+              LIMIT ? OFFSET ?'''
+    params = (*_keyset_params((seller_id,), after, limit), offset)
+    rows = conn.execute(sql, params).fetchall()
+    return [_with_tags(row) for row in rows]
+
+
 def get_offer_price(cursor, offer_id):
     sql = '''SELECT price
              FROM offers
@@ -176,31 +746,92 @@ def get_offer_title(conn, offer_id):
     return row
 
 
-def get_pending_tx_for_buyer(cursor, account_id):
-    sql = '''SELECT *
+# ordered by (start_timestamp, id), `after` is that pair for the last row of
+# the previous page
+def get_pending_tx_for_buyer(cursor, account_id, after=None, limit=None):
+    sql = f'''SELECT *
+              FROM transactions
+              WHERE buyer_id=? AND status="PENDING"
+                {_after_start('start_timestamp', 'id', after)}
+              ORDER BY start_timestamp, id
+              LIMIT ?'''
+    params = _keyset_params((account_id,), after, limit)
+    rows = cursor.execute(sql, params).fetchall()
+    return rows
+
+
+def get_pending_tx_for_offer(conn, offer_id):
+    sql = '''SELECT id, buyer_id
              FROM transactions
-             WHERE buyer_id=? AND status="PENDING"'''
-    rows = cursor.execute(sql, (account_id,)).fetchall()
+             WHERE offer_id=? AND status="PENDING"'''
+    rows = conn.execute(sql, (offer_id,)).fetchall()
     return rows
 
 
-def get_pending_tx_for_seller(conn, account_id):
-    sql = '''SELECT *
-             FROM transactions as t
+# ordered by (start_timestamp, id), `after` is that pair for the last row of
+# the previous page
+def get_pending_tx_for_seller(conn, account_id, after=None, limit=None):
+    sql = f'''SELECT *
+              FROM transactions as t
+              LEFT JOIN offers as o
+              ON (t.offer_id == o.id)
+              WHERE o.seller_id=? AND status="PENDING"
+                {_after_start('t.start_timestamp', 't.id', after)}
+              ORDER BY t.start_timestamp, t.id
+              LIMIT ?'''
+    params = _keyset_params((account_id,), after, limit)
+    rows = conn.execute(sql, params).fetchall()
+    return rows
+
+
+# buyer_id, offer_id, status, seller_id, price for a transaction
+def get_settlement_info(conn, tx_id):
+    sql = '''SELECT t.buyer_id, t.offer_id, t.status, o.seller_id, o.price
+             FROM all_transactions as t
              LEFT JOIN offers as o
              ON (t.offer_id == o.id)
-             WHERE o.seller_id=? AND status="PENDING"'''
-    rows = conn.execute(sql, (account_id,)).fetchall()
+             WHERE t.id=?'''
+    row = conn.execute(sql, (tx_id,)).fetchone()
+    return row
+
+
+# id, buyer_id, offer_id, status, seller_id, price for each existing transaction
+def get_settlement_infos(conn, tx_ids):
+    tx_ids = list(tx_ids)
+    sql = f'''SELECT t.id, t.buyer_id, t.offer_id, t.status, o.seller_id,
+                     o.price
+              FROM all_transactions as t
+              LEFT JOIN offers as o
+              ON (t.offer_id == o.id)
+              WHERE t.id IN ({_placeholders(tx_ids)})'''
+    rows = conn.execute(sql, tx_ids).fetchall()
+    return rows
+
+
+# (tag, count) for each of `tags` that some offer has
+def get_tag_counts(conn, tags):
+    tags = list(tags)
+    sql = f'''SELECT tag, count
+              FROM tag_counts
+              WHERE tag IN ({_placeholders(tags)})'''
+    rows = conn.execute(sql, tags).fetchall()
+    return rows
+
+
+# (tag, count) for the most used tags, most used first
+def get_top_tags(conn, limit):
+    sql = '''SELECT tag, count
+             FROM tag_counts
+             ORDER BY count DESC, tag
+             LIMIT ?'''
+    rows = conn.execute(sql, (limit,)).fetchall()
     return rows
 
 
 def get_total_pending_credits_by_account(conn, account_id):
-    sql = '''SELECT sum(o.price)
-                    FROM offers as o
-                    LEFT JOIN transactions as t
-                    ON (o.id == t.offer_id)
-                    WHERE o.seller_id=? AND t.status="PENDING"
-                    GROUP BY o.seller_id'''
+    sql = '''SELECT pending_credits
+             FROM accounts
+             WHERE id=?'''
     row = conn.execute(sql, (account_id,)).fetchone()
     if row == None:
         return 0
@@ -208,12 +839,9 @@ def get_total_pending_credits_by_account(conn, account_id):
 
 
 def get_total_pending_debits_by_account(conn, account_id):
-    sql = '''SELECT sum(o.price)
-                    FROM offers as o
-                    LEFT JOIN transactions as t
-                    ON (o.id == t.offer_id)
-                    WHERE t.buyer_id=? AND t.status="PENDING"
-                    GROUP BY t.buyer_id'''
+    sql = '''SELECT pending_debits
+             FROM accounts
+             WHERE id=?'''
     row = conn.execute(sql, (account_id,)).fetchone()
     if row == None:
         return 0
@@ -222,7 +850,7 @@ def get_total_pending_debits_by_account(conn, account_id):
 
 def get_transaction(conn, tx_id):
     sql = '''SELECT *
-             FROM transactions
+             FROM all_transactions
              WHERE id=?'''
     row = conn.execute(sql, (tx_id,)).fetchone()
     return row
@@ -230,7 +858,7 @@ def get_transaction(conn, tx_id):
 
 def get_transaction_buyer(conn, tx_id):
     sql = '''SELECT buyer_id
-             FROM transactions
+             FROM all_transactions
              WHERE id=?'''
     row = conn.execute(sql, (tx_id,)).fetchone()
     if row: return row[0]
@@ -239,8 +867,8 @@ def get_transaction_buyer(conn, tx_id):
 
 def get_transaction_seller(conn, tx_id):
     sql = '''SELECT o.seller_id
-             FROM transactions as t
-             LEFT JOIN offer as o
+             FROM all_transactions as t
+             LEFT JOIN offers as o
              ON (t.offer_id == o.id)
              WHERE t.id=?'''
     row = conn.execute(sql, (tx_id,)).fetchone()
@@ -250,39 +878,74 @@ def get_transaction_seller(conn, tx_id):
 
 def get_transaction_status(cursor, tx_id):
     sql = '''SELECT status
-             FROM transactions
+             FROM all_transactions
              WHERE id=?'''
     row = cursor.execute(sql, (tx_id,)).fetchone()
-    if row: rows[0]
+    if row: return row[0]
     return row
 
 
+def mark_outbox_delivered(conn, message_ids):
+    sql = '''UPDATE outbox
+             SET delivered_timestamp=?, attempts=attempts + 1
+             WHERE id=?'''
+    now = int(time.time())
+    conn.executemany(sql, [(now, message_id) for message_id in message_ids])
+
+
 def offers_join_transactions_by_tx_id(conn, tx_id):
     sql = '''SELECT *
              FROM offers as o
-             LEFT JOIN transactions as t
+             LEFT JOIN all_transactions as t
              ON (o.id == t.offer_id)
              WHERE t.id=?'''
     row = conn.execute(sql, (tx_id,)).fetchone()
     return row
 
 
-def update_account_balance(conn, account_id, balance):
+# rows of (next_attempt_timestamp, message_id)
+def reschedule_outbox_messages(conn, rows):
+    sql = '''UPDATE outbox
+             SET next_attempt_timestamp=?, attempts=attempts + 1
+             WHERE id=?'''
+    conn.executemany(sql, rows)
+
+
+# Offer rows (tags appended as a tuple, as get_offers_with_categories) that
+# match an FTS5 query, best BM25 rank first. `tag` and `max_price` narrow
+# the matches when set, `offset` skips rows for numbered pages.
+def search_offers(conn, match, tag=None, max_price=None, limit=None,
+                  offset=0):
+    sql = f'''SELECT o.*, (SELECT group_concat(c.tag, {TAG_SEPARATOR_SQL})
+                           FROM offer_categories as c
+                           WHERE c.offer_id == o.id)
+              FROM offers_fts as f
+              JOIN offers as o
+              ON (o.id == f.rowid)
+              WHERE offers_fts MATCH ?
+                AND (? IS NULL OR EXISTS (SELECT 1
+                                          FROM offer_categories as t
+                                          WHERE t.offer_id == o.id
+                                            AND t.tag=?))
+                AND (? IS NULL OR o.price <= ?)
+              ORDER BY f.rank, o.id
+              LIMIT ? OFFSET ?'''
+    params = (match, tag, tag, max_price, max_price,
+              -1 if limit is None else limit, offset)
+    rows = conn.execute(sql, params).fetchall()
+    return [_with_tags(row) for row in rows]
+
+
+# rows of (balance, pending_debits, pending_credits, account_id)
+def update_account_totals(conn, rows):
     sql = '''UPDATE accounts
-             SET balance=?
+             SET balance=?, pending_debits=?, pending_credits=?
              WHERE id=?'''
-    conn.execute(sql, (balance, account_id))
+    conn.executemany(sql, rows)
 
 
-# used for cancel, deny, and approve (checks)
-def update_transaction_status(cursor, tx_id, status):
-    if status == 'APPROVED':
-        sql = '''UPDATE transactions
-                 SET status=?, end_timestamp=?
-                 WHERE id=?'''
-        cursor.execute(sql, (status, int(time.time()), tx_id))
-    else:
-        sql = '''UPDATE transactions
-                 SET status=?
-                 WHERE id=?'''
-        cursor.execute(sql, (status, tx_id))
+def update_pending_totals(conn, account_id, debits, credits):
+    sql = '''UPDATE accounts
+             SET pending_debits=?, pending_credits=?
+             WHERE id=?'''
+    conn.execute(sql, (debits, credits, account_id))
@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+
+LOCK_STRIPES = int(os.getenv('ACCOUNT_LOCK_STRIPES', 64))
+
+
+class KeyedLocks:
+    ''' Per-key locks striped over a fixed number of re-entrant locks
+
+    `hold(*keys)` takes the stripes for every key in stripe order, so two
+    callers locking the same accounts in a different order (buyer/seller vs
+    seller/buyer) can't deadlock. Keys on different stripes don't block
+    each other.
+    '''
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'acquisitions': 0,
+            'contended': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+        }
+
+
+    def _stripes(self, keys):
+        return sorted({hash(key) % len(self._locks)
+                       for key in keys if key is not None})
+
+
+    @contextmanager
+    def hold(self, *keys):
+        stripes = self._stripes(keys)
+        contended = 0
+        start = time.perf_counter()
+
+        for i in stripes:
+            if not self._locks[i].acquire(blocking=False):
+                contended += 1
+                self._locks[i].acquire()
+
+        waited = time.perf_counter() - start
+
+        with self._stats_lock:
+            self._stats['acquisitions'] += 1
+            self._stats['contended'] += bool(contended)
+            self._stats['wait_time'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+
+        try:
+            yield
+        finally:
+            for i in reversed(stripes):
+                self._locks[i].release()
+
+
+    @contextmanager
+    def hold_all(self):
+        ''' Exclusive access to every key, for maintenance jobs '''
+        for lock in self._locks:
+            lock.acquire()
+
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats, stripes=len(self._locks))
+
+        done = stats['acquisitions']
+        stats['avg_wait'] = stats['wait_time'] / done if done else 0.0
+        return stats
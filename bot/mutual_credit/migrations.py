@@ -0,0 +1,334 @@
+from . import db
+
+from sqlite3 import Error
+
+import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+# Each migration is (version, description, function). Migrations run in
+# order against databases whose schema_version is lower than `version`, each
+# inside its own transaction, so an existing credit_system.db is upgraded in
+# place the next time the bot starts. Never edit or reorder a migration that
+# has been released; append a new one instead.
+
+
+def _key_offers_by_id(conn):
+    # offers used PRIMARY KEY (id, seller_id) but is only ever looked up by id
+    conn.execute(''' CREATE TABLE offers_new (
+                        id text PRIMARY KEY,
+                        seller_id integer,
+                        description text NOT NULL,
+                        price integer NOT NULL,
+                        title text NOT NULL,
+                        FOREIGN KEY(seller_id) REFERENCES members(id)
+                    ); ''')
+    conn.execute(''' INSERT INTO offers_new(id, seller_id, description, price,
+                        title)
+                     SELECT id, seller_id, description, price, title
+                     FROM offers ''')
+    conn.execute('DROP TABLE offers')
+    conn.execute('ALTER TABLE offers_new RENAME TO offers')
+
+
+def _add_hot_path_indexes(conn):
+    conn.execute(''' CREATE INDEX IF NOT EXISTS idx_transactions_buyer_status
+                     ON transactions(buyer_id, status) ''')
+    conn.execute(''' CREATE INDEX IF NOT EXISTS idx_transactions_offer_status
+                     ON transactions(offer_id, status) ''')
+    conn.execute(''' CREATE INDEX IF NOT EXISTS idx_offers_seller
+                     ON offers(seller_id) ''')
+    conn.execute(''' CREATE INDEX IF NOT EXISTS idx_offer_categories_tag
+                     ON offer_categories(tag) ''')
+
+
+def _add_pending_totals(conn):
+    # deleteOffer used to leave requests for the offer pending, with no price
+    # left to count or settle them by
+    conn.execute(''' UPDATE transactions
+                     SET status="CANCELLED", end_timestamp=?
+                     WHERE status="PENDING"
+                       AND offer_id NOT IN (SELECT id FROM offers) ''',
+                 (int(time.time()),))
+    conn.execute(''' ALTER TABLE accounts
+                     ADD COLUMN pending_debits integer NOT NULL DEFAULT 0 ''')
+    conn.execute(''' ALTER TABLE accounts
+                     ADD COLUMN pending_credits integer NOT NULL DEFAULT 0 ''')
+    for account_id, _, _, debits, credits in db.compute_pending_totals(conn):
+        db.update_pending_totals(conn, account_id, debits, credits)
+
+
+def _add_outbox(conn):
+    conn.execute(''' CREATE TABLE outbox (
+                        id integer PRIMARY KEY,
+                        recipient_id int NOT NULL,
+                        event text NOT NULL,
+                        payload text NOT NULL,
+                        created_timestamp int NOT NULL,
+                        attempts int NOT NULL DEFAULT 0,
+                        next_attempt_timestamp int NOT NULL,
+                        delivered_timestamp int
+                    ); ''')
+    conn.execute(''' CREATE INDEX idx_outbox_undelivered
+                     ON outbox(next_attempt_timestamp)
+                     WHERE delivered_timestamp IS NULL ''')
+
+
+def _integer_keys(conn):
+    # offers and transactions were keyed by 32 character uuid4 hex strings,
+    # repeated in every index and referencing row. Integer keys are stored
+    # as the rowid, and members see them as short base32 IDs instead.
+    conn.execute(''' CREATE TEMP TABLE offer_keys (
+                        id integer PRIMARY KEY,
+                        old_id text UNIQUE
+                    ) ''')
+    # offers removed before deleteOffer cancelled their requests are still
+    # referenced by old transactions, so they get keys too
+    conn.execute(''' INSERT INTO offer_keys(old_id)
+                     SELECT id FROM offers ORDER BY rowid ''')
+    conn.execute(''' INSERT OR IGNORE INTO offer_keys(old_id)
+                     SELECT offer_id FROM transactions ORDER BY rowid ''')
+    conn.execute(''' CREATE TEMP TABLE tx_keys (
+                        id integer PRIMARY KEY,
+                        old_id text UNIQUE
+                    ) ''')
+    conn.execute(''' INSERT INTO tx_keys(old_id)
+                     SELECT id FROM transactions
+                     ORDER BY start_timestamp, rowid ''')
+
+    # AUTOINCREMENT so a removed offer's ID is never given to a new one
+    conn.execute(''' CREATE TABLE offers_new (
+                        id integer PRIMARY KEY AUTOINCREMENT,
+                        seller_id integer,
+                        description text NOT NULL,
+                        price integer NOT NULL,
+                        title text NOT NULL,
+                        FOREIGN KEY(seller_id) REFERENCES members(id)
+                    ); ''')
+    conn.execute(''' INSERT INTO offers_new(id, seller_id, description, price,
+                        title)
+                     SELECT k.id, o.seller_id, o.description, o.price, o.title
+                     FROM offers as o
+                     JOIN offer_keys as k ON (k.old_id == o.id) ''')
+
+    conn.execute(''' CREATE TABLE offer_categories_new (
+                        offer_id integer,
+                        tag text,
+                        PRIMARY KEY (offer_id, tag)
+                    ); ''')
+    conn.execute(''' INSERT INTO offer_categories_new(offer_id, tag)
+                     SELECT k.id, c.tag
+                     FROM offer_categories as c
+                     JOIN offer_keys as k ON (k.old_id == c.offer_id) ''')
+
+    conn.execute(''' CREATE TABLE transactions_new (
+                        id integer PRIMARY KEY AUTOINCREMENT,
+                        buyer_id int NOT NULL,
+                        offer_id integer NOT NULL,
+                        status text NOT NULL,
+                        start_timestamp int NOT NULL,
+                        end_timestamp int,
+                        FOREIGN KEY(buyer_id) REFERENCES members(id),
+                        FOREIGN KEY(offer_id) REFERENCES offers(id)
+                    ); ''')
+    conn.execute(''' INSERT INTO transactions_new(id, buyer_id, offer_id,
+                        status, start_timestamp, end_timestamp)
+                     SELECT k.id, t.buyer_id, o.id, t.status,
+                        t.start_timestamp, t.end_timestamp
+                     FROM transactions as t
+                     JOIN tx_keys as k ON (k.old_id == t.id)
+                     JOIN offer_keys as o ON (o.old_id == t.offer_id) ''')
+
+    for table in ('offers', 'offer_categories', 'transactions'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+    # dropped along with the old tables
+    _add_hot_path_indexes(conn)
+
+    # keys of removed offers are taken too
+    conn.execute('DELETE FROM sqlite_sequence WHERE name="offers"')
+    conn.execute(''' INSERT INTO sqlite_sequence(name, seq)
+                     SELECT "offers", coalesce(max(id), 0) FROM offer_keys ''')
+
+    # notifications not sent yet refer to transactions by the old IDs
+    rows = conn.execute(''' SELECT id, payload FROM outbox
+                            WHERE delivered_timestamp IS NULL ''').fetchall()
+
+    for message_id, payload in rows:
+        payload = json.loads(payload)
+        if 'tx_id' not in payload:
+            continue
+
+        row = conn.execute('SELECT id FROM tx_keys WHERE old_id=?',
+                           (payload['tx_id'],)).fetchone()
+
+        # the transaction wasn't carried over, so there's nothing to point at
+        if row is None:
+            conn.execute('DELETE FROM outbox WHERE id=?', (message_id,))
+            continue
+
+        payload['tx_id'] = row[0]
+        conn.execute('UPDATE outbox SET payload=? WHERE id=?',
+                     (json.dumps(payload), message_id))
+
+    conn.execute('DROP TABLE offer_keys')
+    conn.execute('DROP TABLE tx_keys')
+
+
+def _add_ledger(conn):
+    # append-only record of every balance change, see db.create_ledger_entries
+    conn.execute(''' CREATE TABLE ledger_entries (
+                        id integer PRIMARY KEY AUTOINCREMENT,
+                        account_id int NOT NULL,
+                        tx_id integer,
+                        kind text NOT NULL,
+                        amount integer NOT NULL,
+                        balance integer NOT NULL,
+                        timestamp int NOT NULL
+                    ); ''')
+    conn.execute(''' CREATE INDEX idx_ledger_entries_account
+                     ON ledger_entries(account_id, id) ''')
+    conn.execute(''' CREATE INDEX idx_ledger_entries_checkpoints
+                     ON ledger_entries(account_id, timestamp)
+                     WHERE kind="CHECKPOINT" ''')
+
+    # history before this point isn't known, so it opens at today's balances
+    db.create_ledger_entries(conn, [
+        (account_id, None, 'CHECKPOINT', 0, balance)
+        for account_id, balance in
+        conn.execute('SELECT id, balance FROM accounts').fetchall()])
+
+
+def _add_archive_index(conn):
+    # finds the settled transactions due to move to transactions_history,
+    # see db.archive_transactions
+    conn.execute(''' CREATE INDEX idx_transactions_settled
+                     ON transactions(coalesce(end_timestamp, start_timestamp))
+                     WHERE status!="PENDING" ''')
+
+
+def _add_offer_search(conn):
+    # full-text index over offer titles and descriptions, reading the text
+    # from offers itself and kept current by the triggers below. A migration
+    # that rebuilds offers has to recreate the triggers.
+    conn.execute(''' CREATE VIRTUAL TABLE offers_fts USING fts5(
+                        title,
+                        description,
+                        content='offers',
+                        content_rowid='id',
+                        tokenize='porter unicode61 remove_diacritics 2'
+                    ) ''')
+    # rank by BM25 with title matches counting ten times a description match
+    conn.execute(''' INSERT INTO offers_fts(offers_fts, rank)
+                     VALUES('rank', 'bm25(10.0, 1.0)') ''')
+    conn.execute(''' CREATE TRIGGER offers_fts_insert AFTER INSERT ON offers
+                     BEGIN
+                        INSERT INTO offers_fts(rowid, title, description)
+                        VALUES(new.id, new.title, new.description);
+                     END ''')
+    conn.execute(''' CREATE TRIGGER offers_fts_delete AFTER DELETE ON offers
+                     BEGIN
+                        INSERT INTO offers_fts(offers_fts, rowid, title,
+                            description)
+                        VALUES('delete', old.id, old.title, old.description);
+                     END ''')
+    conn.execute(''' CREATE TRIGGER offers_fts_update
+                     AFTER UPDATE OF title, description ON offers
+                     BEGIN
+                        INSERT INTO offers_fts(offers_fts, rowid, title,
+                            description)
+                        VALUES('delete', old.id, old.title, old.description);
+                        INSERT INTO offers_fts(rowid, title, description)
+                        VALUES(new.id, new.title, new.description);
+                     END ''')
+    conn.execute('INSERT INTO offers_fts(offers_fts) VALUES("rebuild")')
+
+
+def _add_tag_counts(conn):
+    # deleting an offer used to leave its tags behind
+    conn.execute(''' DELETE FROM offer_categories
+                     WHERE offer_id NOT IN (SELECT id FROM offers) ''')
+    # offers per tag, kept current by db.create_offer_tag/delete_offer_tag
+    conn.execute(''' CREATE TABLE tag_counts (
+                        tag text PRIMARY KEY,
+                        count integer NOT NULL
+                    ) WITHOUT ROWID ''')
+    conn.execute(''' INSERT INTO tag_counts(tag, count)
+                     SELECT tag, count(*)
+                     FROM offer_categories
+                     GROUP BY tag ''')
+    # offer_categories is a rowid table, so an index on tag alone still
+    # needs a table lookup per row to find the offer
+    conn.execute('DROP INDEX IF EXISTS idx_offer_categories_tag')
+    conn.execute(''' CREATE INDEX idx_offer_categories_tag_offer
+                     ON offer_categories(tag, offer_id) ''')
+
+
+MIGRATIONS = [
+    (1, 'key offers by id', _key_offers_by_id),
+    (2, 'add hot-path indexes', _add_hot_path_indexes),
+    (3, 'add pending totals to accounts', _add_pending_totals),
+    (4, 'add notification outbox', _add_outbox),
+    (5, 'use integer keys for offers and transactions', _integer_keys),
+    (6, 'add double-entry ledger', _add_ledger),
+    (7, 'index settled transactions for archiving', _add_archive_index),
+    (8, 'add offer full-text search', _add_offer_search),
+    (9, 'add tag counts and tag index', _add_tag_counts),
+]
+
+
+def _init_schema_version_table(conn):
+    conn.execute(''' CREATE TABLE IF NOT EXISTS schema_version (
+                        version integer PRIMARY KEY,
+                        description text NOT NULL,
+                        applied_timestamp int NOT NULL
+                    ); ''')
+    conn.commit()
+
+
+def get_schema_version(conn):
+    _init_schema_version_table(conn)
+    row = conn.execute('SELECT max(version) FROM schema_version').fetchone()
+    if row[0] is None: return 0
+    return row[0]
+
+
+# `target` stops at that version instead of the latest, for benchmarks
+def migrate(conn, target=None):
+    current = get_schema_version(conn)
+
+    # a rename is checked against every view, and all_transactions would
+    # fail while a migration rebuilds the tables under it
+    conn.execute('DROP VIEW IF EXISTS temp.all_transactions')
+
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+
+        if target is not None and version > target:
+            break
+
+        log.info(f'migrate: applying {version} ({description})')
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            func(conn)
+            conn.execute('''INSERT INTO schema_version(version, description,
+                                applied_timestamp)
+                            VALUES(?, ?, ?)''',
+                         (version, description, int(time.time())))
+            conn.commit()
+        except Error as e:
+            conn.rollback()
+            log.error(f'migrate: migration {version} failed: {e}')
+            raise
+
+        current = version
+
+    db.init_views(conn)
+
+    return current
@@ -0,0 +1,128 @@
+from .utils import iter_chunks
+
+import asyncio
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+# messages to the same member within this many seconds are sent as one DM
+NOTIFY_COALESCE_WINDOW = float(os.getenv('NOTIFY_COALESCE_WINDOW', 0.5))
+# most DMs being sent at once, discord.py still handles 429 retries itself
+NOTIFY_MAX_CONCURRENCY = int(os.getenv('NOTIFY_MAX_CONCURRENCY', 5))
+
+
+class NotificationDispatcher:
+    ''' Sends DMs in the background so command handlers only enqueue them
+
+    Messages for the same recipient are held for a short window and sent
+    together. `notify()` returns a future that resolves to True once the
+    message was delivered, or False if it couldn't be.
+    '''
+
+    def __init__(self, client, window=NOTIFY_COALESCE_WINDOW,
+                 max_concurrency=NOTIFY_MAX_CONCURRENCY):
+        self.client = client
+        self.window = window
+        self.max_concurrency = max_concurrency
+        self._pending = {}
+        self._channels = {}
+        self._slots = None
+        self._stats = {
+            'queued': 0,
+            'sent': 0,
+            'failed': 0,
+            'dms': 0,
+            'in_flight': 0,
+            'max_latency': 0.0,
+            'total_latency': 0.0,
+        }
+
+
+    def notify(self, recipient_id, content):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        batch = self._pending.get(recipient_id)
+
+        if batch is None:
+            batch = self._pending[recipient_id] = []
+            loop.call_later(self.window, self._flush, recipient_id)
+
+        batch.append((content, future, time.perf_counter()))
+        self._stats['queued'] += 1
+
+        return future
+
+
+    def _flush(self, recipient_id):
+        batch = self._pending.pop(recipient_id, [])
+        if batch:
+            asyncio.ensure_future(self._send(recipient_id, batch))
+
+
+    async def _dm_channel(self, recipient_id):
+        channel = self._channels.get(recipient_id)
+        if channel:
+            return channel
+
+        member = self.client.member_for(recipient_id)
+        if member is None:
+            return None
+
+        channel = member.dm_channel or await member.create_dm()
+        self._channels[recipient_id] = channel
+
+        return channel
+
+
+    async def _send(self, recipient_id, batch):
+        # the dispatcher is built at import time, before discord starts its loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+
+        stats = self._stats
+        delivered = False
+
+        async with self._slots:
+            stats['in_flight'] += 1
+
+            try:
+                channel = await self._dm_channel(recipient_id)
+
+                if channel is None:
+                    log.warning(f'notify: member {recipient_id} not found')
+                else:
+                    contents = [content for content, _, _ in batch]
+                    async for chunk in iter_chunks(contents):
+                        await channel.send(chunk)
+                        stats['dms'] += 1
+                    delivered = True
+
+            except Exception as e:
+                log.exception(f'notify: failed to DM {recipient_id}: {e}')
+                # the channel may have gone stale, look it up again next time
+                self._channels.pop(recipient_id, None)
+
+            finally:
+                stats['in_flight'] -= 1
+
+        now = time.perf_counter()
+
+        for _, future, queued in batch:
+            latency = now - queued
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['sent' if delivered else 'failed'] += 1
+
+            if not future.done():
+                future.set_result(delivered)
+
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['pending'] = sum(len(batch) for batch in self._pending.values())
+        done = stats['sent'] + stats['failed']
+        stats['avg_latency'] = stats['total_latency'] / done if done else 0.0
+        return stats
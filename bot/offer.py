@@ -1,4 +1,4 @@
-from .mutual_credit import credit_system as cs
+from .mutual_credit import async_credit_system as cs
 from .mutual_credit.errors import (
     AccountIDError,
     OfferIDError,
@@ -8,38 +8,48 @@ from .mutual_credit.errors import (
     UserPermissionError
 )
 
-from .utils import user_from_id, mention_to_id, role_check
+from .commands import subcommand
+from .utils import (
+    as_async_iter,
+    from_public_id,
+    mention_to_id,
+    reply_chunked,
+    to_public_id,
+    user_from_id
+)
 
+import os
 import shlex
 import logging
 
 log = logging.getLogger(__name__)
 
+COMMAND_PREFIX = os.environ['COMMAND_PREFIX']
+
 
 
+@subcommand('offer', 'add', min_args=3,
+            usage='offer add TITLE PRICE DESCRIPTION [TAG TAG ...]', writes=True)
 async def subcmd_add(client, message, args):
     ''' Create a new offer for calling account '''
 
-    if len(args) < 3:
-        raise Exception('Invalid number of arguments.')
-
     user = message.author
     title, price, description = args[:3]
 
-    offer_id = cs.createOffer(user.id, description, price, title)
+    offer_id = await cs.createOffer(user.id, description, price, title)
 
     if len(args) > 3: # user supplies optional tags
-        cs.addCategoriesToOffer(user.id, offer_id, args[3:])
+        await cs.addCategoriesToOffer(user.id, offer_id, args[3:])
 
-    await message.reply(f'Created offer with ID {offer_id}.')
+    await message.reply(f'Created offer with ID {to_public_id(offer_id)}.')
 
 
+@subcommand('offer', 'remove', min_args=1,
+            usage='offer remove OFFER_ID [OFFER_ID OFFER_ID]', writes=True,
+            cost=len)
 async def subcmd_remove(client, message, args):
     ''' Delete one or more offers for caller '''
 
-    if len(args) < 1:
-        raise Exception(f'You must provide at least one offer ID.')
-
     user = message.author
     offer_ids = args
 
@@ -51,7 +61,10 @@ async def subcmd_remove(client, message, args):
             response += f'{i+1}/{len(offer_ids)}:'
 
         try:
-            cs.deleteOffer(user.id, offer_id)
+            await cs.deleteOffer(user.id, from_public_id(offer_id))
+        except OfferIDError as e:
+            response += f' Skipping offer {offer_id}.'
+            response += ' An offer with that ID doesn\'t exist.\n'
         except TransactionIDError as e:
             response += f' Skipping offer {offer_id}.'
             response += ' A transaction with that ID doesn\'t exist.\n'
@@ -67,108 +80,227 @@ async def subcmd_remove(client, message, args):
         else:
             response += f' Deleted offer {offer_id}.\n'
 
+    # buyers with pending requests are notified through the outbox
+    client.outbox.wake()
+
     # remove last line break
     response = response[:-1]
     await message.reply(response)
 
 
+OFFERS_PAGE_SIZE = 10
+
+# the largest integer SQLite can bind
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+
+def _parse_page(value):
+    if not value.isdecimal() or int(value) < 1:
+        raise Exception('--page must be a positive number')
+
+    # the OFFSET for later pages doesn't fit in a SQLite integer
+    if (int(value) - 1) * OFFERS_PAGE_SIZE > SQLITE_MAX_INT:
+        raise Exception(f'--page {value} is too large')
+
+    return int(value)
+
+
+def _parse_show_args(args):
+    mention, page, after = None, None, None
+    args = list(args)
+
+    while args:
+        arg = args.pop(0)
+
+        if arg in ('--page', '--after'):
+            if not args:
+                raise Exception(f'{arg} requires a value')
+            value = args.pop(0)
+
+            if arg == '--page':
+                page = _parse_page(value)
+            else:
+                after = from_public_id(value)
+                if after is None:
+                    raise Exception(f'{value} is not an offer ID')
+
+        elif mention is None:
+            mention = arg
+
+        else:
+            raise Exception('Invalid number of arguments')
+
+    if page is not None and after is not None:
+        raise Exception('Use either --page or --after, not both')
+
+    return mention, page, after
+
+
+# every offer of the seller, fetched one keyset page at a time
+async def _iter_offers(seller_id):
+    after = None
+
+    while True:
+        offers = await cs.getOffersWithCategories(seller_id, after=after,
+                                                  limit=OFFERS_PAGE_SIZE)
+        for offer in offers:
+            yield offer
+
+        if len(offers) < OFFERS_PAGE_SIZE:
+            return
+
+        after = offers[-1][0]
+
+
+# seller ID -> name for offer rows, names rather than mentions so sellers
+# aren't pinged whenever their offers are listed
+def seller_names(client, offers):
+    sellers = {}
+
+    for offer in offers:
+        member = client.member_for(offer[1])
+        sellers[offer[1]] = member.name if member else str(offer[1])
+
+    return sellers
+
+
+# `sellers` maps seller IDs to names, for listings from several sellers
+async def render_offers(header, offers, next_page=None,
+                        empty='Account has no offers.', sellers=None):
+    offer_strfmt = '{title} | ${price}\n{desc}\nCategories: {cats}\nID: {off_id}'
+    total = 0
+
+    async for offer in as_async_iter(offers):
+        if total == 0:
+            yield header
+
+        categories = offer[5]
+        if len(categories):
+            categories = ', '.join(categories)
+        else:
+            categories = '---'
+
+        rendered = offer_strfmt.format(
+            off_id = to_public_id(offer[0]),
+            sell_id = offer[1],
+            desc = offer[2],
+            price = offer[3],
+            title = offer[4],
+            cats = categories
+        )
+
+        if sellers:
+            rendered += f'\nSeller: {sellers[offer[1]]}'
+
+        yield rendered
+        total += 1
+
+    if total == 0:
+        yield empty
+    elif next_page and total == OFFERS_PAGE_SIZE:
+        yield f'More offers: `{next_page}`'
+
+
+@subcommand('offer', 'show',
+            usage='offer show [@USER] [--page N | --after OFFER_ID]')
 async def subcmd_show(client, message, args):
-    ''' List all offers for account '''
+    ''' List offers for account, optionally one page at a time '''
 
     user = message.author
     seller_name = None
     seller_id = None
 
-    if len(args) == 0:
+    mention, page, after = _parse_show_args(args)
+
+    if mention is None:
         seller_id = user.id
         seller_name = user.name
-    elif len(args) == 1:
-        seller_id = mention_to_id(args[0])
+    else:
+        seller_id = mention_to_id(mention)
         if not seller_id:
             raise Exception('Invalid user mention provided')
         seller = await user_from_id(client, seller_id)
         seller_name = seller.name
-    else:
-        raise Exception('Invalid number of arguments')
+
+    show_cmd = f'{COMMAND_PREFIX}offer show'
+    if mention:
+        show_cmd += f' {mention}'
 
     try:
-        offers = cs.getOffers(seller_id)
+        if page is not None:
+            offers = await cs.getOffersWithCategories(
+                seller_id, limit=OFFERS_PAGE_SIZE,
+                offset=(page - 1) * OFFERS_PAGE_SIZE)
+            next_page = f'{show_cmd} --page {page + 1}'
+        elif after is not None:
+            offers = await cs.getOffersWithCategories(
+                seller_id, after=after, limit=OFFERS_PAGE_SIZE)
+            next_page = f'{show_cmd} --after {to_public_id(offers[-1][0])}' if offers else None
+        else:
+            offers = _iter_offers(seller_id)
+            next_page = None
+
+        paged = page is not None or after is not None
+        empty = 'No more offers.' if paged else 'Account has no offers.'
+        header = f'{seller_name}\'s Offers:'
+        await reply_chunked(message, render_offers(header, offers, next_page,
+                                                   empty))
     except AccountIDError as e:
         await message.reply(f'No seller with ID {seller_id} exists.')
-    else:
-        if not offers:
-            await message.reply(f'Account has no offers.')
-            return
-
-        response = f'{seller_name}\'s Offers:\n\n'
-
-        offer_strfmt = '{title} | ${price}\n{desc}\nCategories: {cats}\nID: {off_id}\n\n'
-
-        for offer in offers:
-            categories = cs.getOfferCategories(offer[0])
-            if len(categories):
-                categories = ', '.join(categories)
-            else:
-                categories = '---'
-
-
-            response += offer_strfmt.format(
-                off_id = offer[0],
-                sell_id = offer[1],
-                desc = offer[2],
-                price = offer[3],
-                title = offer[4],
-                cats = categories
-            )
 
-        #strip last line breaks
-        response = response[:-2]
-        await message.reply(response)
 
+def _parse_search_args(args):
+    words, tag, max_price, page = [], None, None, 1
+    args = list(args)
 
-async def handle(client, message, args):
-    if len(args) < 1:  # TODO: Add an CommandArgumentsError
-        raise Exception('Invalid number of arguments')
+    while args:
+        arg = args.pop(0)
 
-    subcmd = args[0]
-    args = args[1:]
+        if arg in ('--tag', '--max-price', '--page'):
+            if not args:
+                raise Exception(f'{arg} requires a value')
+            value = args.pop(0)
 
-    user = message.author
-    is_admin = await role_check(client, user.id, 'admin')
-    is_member = await role_check(client, user.id, 'member')
-
-    try:
-        # non-member sub-commands up here
-
-        # member-only sub-commands down here
+            if arg == '--tag':
+                tag = value
+            elif arg == '--page':
+                page = _parse_page(value)
+            elif not value.isdecimal():
+                raise Exception('--max-price must be a number')
+            elif int(value) > SQLITE_MAX_INT:
+                raise Exception(f'--max-price {value} is too large')
+            else:
+                max_price = int(value)
 
-        if not is_member:
-            raise Exception('You are not a member.')
+        else:
+            words.append(arg)
 
-        if subcmd == 'add':
-            try:
-                await subcmd_add(client, message, args)
+    if not words:
+        raise Exception('Nothing to search for')
 
-            except AccountIDError as e:
-                raise e
+    return words, tag, max_price, page
 
-        elif subcmd == 'remove':
-            try:
-                await subcmd_remove(client, message, args)
 
-            except AccountIDError as e:
-                raise e
+@subcommand('offer', 'search', min_args=1,
+            usage='offer search WORDS [--tag TAG] [--max-price N] [--page N]')
+async def subcmd_search(client, message, args):
+    ''' Find offers of every seller by words in their title or description '''
 
-        elif subcmd == 'show':
-            try:
-                await subcmd_show(client, message, args)
+    words, tag, max_price, page = _parse_search_args(args)
 
-            except AccountIDError as e:
-                raise e
+    offers = await cs.searchOffers(' '.join(words), tag, max_price,
+                                   limit=OFFERS_PAGE_SIZE,
+                                   offset=(page - 1) * OFFERS_PAGE_SIZE)
 
-        else:
-            await message.reply('I don\'t know that sub-command!')
+    search_args = list(words)
+    if tag is not None:
+        search_args += ['--tag', tag]
+    if max_price is not None:
+        search_args += ['--max-price', str(max_price)]
+    next_page = (f'{COMMAND_PREFIX}offer search {shlex.join(search_args)} '
+                 f'--page {page + 1}')
 
-    except AccountIDError as e:
-        print(e)
-        await message.reply('You need an account to do that')
+    empty = 'No more offers.' if page > 1 else 'No offers found.'
+    await reply_chunked(message, render_offers('Offers found:', offers,
+                                               next_page, empty,
+                                               seller_names(client, offers)))
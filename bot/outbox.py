@@ -0,0 +1,116 @@
+from .mutual_credit import async_credit_system as cs
+from .utils import tasks_running, to_public_id
+
+import asyncio
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+# retry delay in seconds doubles per attempt, up to the maximum
+OUTBOX_RETRY_BASE = int(os.getenv('OUTBOX_RETRY_BASE', 10))
+OUTBOX_RETRY_MAX = int(os.getenv('OUTBOX_RETRY_MAX', 3600))
+
+
+TEMPLATES = {
+    'APPROVED': '{actor} approved your buy request with ID {tx_id}',
+    'CANCELLED': '{actor} cancelled their transaction request with ID {tx_id}',
+    'DENIED': '{actor} denied your transaction request: {tx_id}\n'
+              'New available balance: ${available_balance}',
+    'OFFER_REMOVED': '{actor} removed their offer {title}, so your transaction'
+                     ' request {tx_id} was cancelled',
+    'REQUESTED': 'New buy request with ID {tx_id} from {actor} for {title}.',
+}
+
+
+class OutboxWorker:
+    ''' Delivers the notification outbox written by credit_system
+
+    Rows are read in batches, handed to the client's NotificationDispatcher
+    and marked delivered once sent. Failed rows are retried with exponential
+    backoff until OUTBOX_MAX_ATTEMPTS is reached.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self._task = None
+        self._wake = None
+
+
+    def start(self):
+        if tasks_running([self._task]):
+            return
+
+        self._wake = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+
+    def wake(self):
+        ''' Drain now rather than at the next poll, e.g. after a command '''
+        if self._wake:
+            self._wake.set()
+
+
+    def _render(self, event, payload):
+        actor = self.client.member_for(payload.get('actor_id'))
+        actor = actor.name if actor else f'<@{payload.get("actor_id")}>'
+
+        if payload.get('tx_id') is not None:
+            payload = dict(payload, tx_id=to_public_id(payload['tx_id']))
+
+        return TEMPLATES[event].format(actor=actor, **payload)
+
+
+    def _retry_at(self, attempts):
+        delay = min(OUTBOX_RETRY_BASE * 2 ** attempts, OUTBOX_RETRY_MAX)
+        return int(time.time()) + delay
+
+
+    async def drain(self):
+        ''' Deliver one batch of due messages, returns how many were due '''
+        rows = await cs.getDueNotifications(OUTBOX_MAX_ATTEMPTS,
+                                            OUTBOX_BATCH_SIZE)
+
+        if not rows:
+            return 0
+
+        futures = [
+            self.client.notifier.notify(recipient_id,
+                                        self._render(event, payload))
+            for _, recipient_id, event, payload, _ in rows
+        ]
+        delivered = await asyncio.gather(*futures)
+
+        sent = [row[0] for row, ok in zip(rows, delivered) if ok]
+        failed = [(self._retry_at(row[4]), row[0])
+                  for row, ok in zip(rows, delivered) if not ok]
+
+        if sent:
+            await cs.markNotificationsDelivered(sent)
+        if failed:
+            log.warning(f'outbox: {len(failed)} notifications will be retried')
+            await cs.rescheduleNotifications(failed)
+
+        return len(rows)
+
+
+    async def _run(self):
+        while True:
+            try:
+                # keep going while full batches are coming back
+                while await self.drain() == OUTBOX_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                log.exception(f'outbox: drain failed: {e}')
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wake.clear()
@@ -0,0 +1,63 @@
+import os
+import time
+
+
+# bucket size and refill rate in tokens per second, per member and class
+RATE_READ_CAPACITY = float(os.getenv('RATE_READ_CAPACITY', 20))
+RATE_READ_REFILL = float(os.getenv('RATE_READ_REFILL', 1))
+RATE_WRITE_CAPACITY = float(os.getenv('RATE_WRITE_CAPACITY', 30))
+RATE_WRITE_REFILL = float(os.getenv('RATE_WRITE_REFILL', 0.5))
+
+
+class RateLimiter:
+    ''' Token buckets keyed by (member id, command class)
+
+    Each class ('read' or 'write') has its own capacity and refill rate.
+    `acquire()` takes `cost` tokens if the bucket has them, otherwise it
+    takes nothing and returns how many seconds until it will.
+    '''
+
+    def __init__(self, limits=None, clock=time.monotonic):
+        self.limits = limits or {
+            'read': (RATE_READ_CAPACITY, RATE_READ_REFILL),
+            'write': (RATE_WRITE_CAPACITY, RATE_WRITE_REFILL),
+        }
+        self._clock = clock
+        self._buckets = {}
+        self._stats = {kind: {'allowed': 0, 'throttled': 0, 'tokens': 0}
+                       for kind in self.limits}
+        self._throttled_members = {}
+
+
+    def acquire(self, member_id, kind, cost=1):
+        ''' Returns 0 if allowed, else the seconds to wait before retrying '''
+        capacity, refill = self.limits[kind]
+        now = self._clock()
+        tokens, updated = self._buckets.get((member_id, kind), (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill)
+        stats = self._stats[kind]
+
+        if cost <= tokens:
+            self._buckets[(member_id, kind)] = (tokens - cost, now)
+            stats['allowed'] += 1
+            stats['tokens'] += cost
+            return 0
+
+        self._buckets[(member_id, kind)] = (tokens, now)
+        stats['throttled'] += 1
+        self._throttled_members[member_id] = \
+            self._throttled_members.get(member_id, 0) + 1
+
+        # more than a full bucket can never be paid for
+        if cost > capacity or refill <= 0:
+            return float('inf')
+
+        return (cost - tokens) / refill
+
+
+    def stats(self):
+        stats = {kind: dict(kind_stats) for kind, kind_stats in self._stats.items()}
+        stats['members'] = len({member_id for member_id, _ in self._buckets})
+        top = sorted(self._throttled_members.items(), key=lambda item: -item[1])
+        stats['top_throttled'] = top[:5]
+        return stats
@@ -0,0 +1,43 @@
+from .commands import command_stats, subcommand
+from .mutual_credit import async_credit_system as cs
+
+from .utils import reply_chunked
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def _format(name, stats):
+    lines = [f'**{name}**']
+
+    for key, value in stats.items():
+        if isinstance(value, float):
+            value = f'{value:.4f}'
+        lines.append(f'`{key}`: {value}')
+
+    return '\n'.join(lines)
+
+
+@subcommand('stats', roles=('admin',), max_args=0, usage='stats')
+async def handle(client, message, args): # admin-only command
+    limits = client.limiter.stats()
+    queues = cs.queue_stats()
+
+    sections = {
+        'Rate limits (read)': limits['read'],
+        'Rate limits (write)': limits['write'],
+        'Throttled members': dict(limits['top_throttled']),
+        'DB queues (reader)': queues['reader'],
+        'DB queues (writer)': queues['writer'],
+        'DB pool': await cs.getPoolStats(),
+        'Account locks': await cs.getLockStats(),
+        'Offer cache': await cs.getOfferCacheStats(),
+        'Notifications': client.notifier.stats(),
+    }
+
+    rows = [_format(name, stats) for name, stats in sections.items()]
+    rows += [_format(f'Command `{key}`', timing)
+             for key, timing in sorted(command_stats().items())]
+
+    await reply_chunked(message, rows)
@@ -1,72 +1,80 @@
-from .mutual_credit import credit_system as cs
+from .mutual_credit import async_credit_system as cs
 from .mutual_credit.errors import OfferIDError, UserPermissionError
 
-from .utils import role_check
+from .commands import subcommand
+from .offer import OFFERS_PAGE_SIZE, render_offers, seller_names
+from .utils import from_public_id, reply_chunked, to_public_id
 
+import os
 import shlex
 import logging
 
 log = logging.getLogger(__name__)
 
+# this way instead of `os.getenv(...)` to make sure that it's set
+COMMAND_PREFIX = os.environ['COMMAND_PREFIX']
 
+TAG_LIST_SIZE = 25
+
+
+@subcommand('tag', 'add', min_args=2, usage='tag add OFFER_ID TAG [TAG ...]',
+            writes=True)
 async def subcmd_add(client, message, args):
     ''' Create one or more categories for offer of caller '''
 
-    if len(args) < 2:
-        raise Exception('Must provide at least one offer ID and one tag')
-
     offer_id = args[0]
+    offer_key = from_public_id(offer_id)
     categories = args[1:]
 
     user = message.author
 
     try:
-        cs.addCategoriesToOffer(user.id, offer_id, categories)
+        await cs.addCategoriesToOffer(user.id, offer_key, categories)
     except OfferIDError as e:
         await message.reply(f'An offer with ID {offer_id} does not exist')
     except UserPermissionError as e:
         await message.reply('You are not allowed to edit someone else\'s offer')
     else:
-        categories = cs.getOfferCategories(offer_id)
+        categories = await cs.getOfferCategories(offer_key)
         categories = ', '.join(categories)
         await message.reply(f'Offer now has the following categories: {categories}')
 
 
+@subcommand('tag', 'remove', min_args=2,
+            usage='tag remove OFFER_ID TAG [TAG ...]', writes=True)
 async def subcmd_remove(client, message, args):
-    print(args)
     ''' Remove one or more categories from offer of caller '''
 
-    if len(args) < 2:
-        raise Exception('Must provide at least one offer ID and one tag')
-
     offer_id = args[0]
+    offer_key = from_public_id(offer_id)
     categories = args[1:]
 
     user = message.author
 
 
     try:
-        cs.removeCategoriesFromOffer(user.id, offer_id, categories)
+        await cs.removeCategoriesFromOffer(user.id, offer_key, categories)
+    except OfferIDError as e:
+        await message.reply(f'An offer with ID {offer_id} does not exist')
     except UserPermissionError as e:
         await message.reply('You are not allowed to edit someone else\'s offer')
     else:
-        categories = cs.getOfferCategories(offer_id)
+        categories = await cs.getOfferCategories(offer_key)
         categories = ', '.join(categories)
         await message.reply(f'Offer now has the following categories: {categories}')
 
 
+@subcommand('tag', 'show', min_args=1, max_args=1, usage='tag show OFFER_ID')
 async def subcmd_show(client, message, args):
     ''' List all categories for offer of caller '''
 
-    if len(args) != 1:
-        raise Exception('Must provide an offer ID')
-
     offer_id = args[0]
+    offer_key = from_public_id(offer_id)
 
     user = message.author
 
     try:
-        categories = cs.getOfferCategories(offer_id)
+        categories = await cs.getOfferCategories(offer_key)
         categories = ', '.join(categories)
     except OfferIDError as e:
         await message.reply(f'An offer with ID {offer_id} doesn\'t exist.')
@@ -74,49 +82,61 @@ async def subcmd_show(client, message, args):
         await message.reply(f'Offer {offer_id} categories: {categories}')
 
 
-async def handle(client, message, args):
-    if len(args) < 1:
-        raise Exception('Must provide a sub-command')
+def _parse_browse_args(args):
+    tags, after = [], None
+    args = list(args)
 
-    subcmd = args[0]
-    args = args[1:]
+    while args:
+        arg = args.pop(0)
 
-    user = message.author
-    is_admin = await role_check(client, user.id, 'admin')
-    is_member = await role_check(client, user.id, 'member')
+        if arg == '--after':
+            if not args:
+                raise Exception(f'{arg} requires a value')
+            value = args.pop(0)
 
-    try:
-        # non-member sub-commands up here
+            after = from_public_id(value)
+            if after is None:
+                raise Exception(f'{value} is not an offer ID')
+
+        else:
+            tags.append(arg)
 
-        # member-only sub-commands down here
+    if not tags:
+        raise Exception('No tags given')
 
-        if not is_member:
-            raise Exception('You are not a member.')
+    return tags, after
 
-        if subcmd == 'add':
-            try:
-                await subcmd_add(client, message, args)
 
-            except AccountIDError as e:
-                await message.reply('You don\'t have an account.')
+@subcommand('tag', 'browse', min_args=1,
+            usage='tag browse TAG [TAG ...] [--after OFFER_ID]')
+async def subcmd_browse(client, message, args):
+    ''' List offers that have every one of the given tags '''
 
-        elif subcmd == 'remove':
-            try:
-                await subcmd_remove(client, message, args)
+    tags, after = _parse_browse_args(args)
 
-            except AccountIDError as e:
-                await message.reply('You don\'t have an account.')
+    offers = await cs.getOffersByTags(tags, after=after,
+                                      limit=OFFERS_PAGE_SIZE)
 
-        elif subcmd == 'show':
-            try:
-                await subcmd_show(client, message, args)
+    next_page = None
+    if offers:
+        next_page = (f'{COMMAND_PREFIX}tag browse {shlex.join(tags)} '
+                     f'--after {to_public_id(offers[-1][0])}')
 
-            except AccountIDError as e:
-                await message.reply('You don\'t have an account.')
+    empty = 'No more offers.' if after is not None else 'No offers have those tags.'
+    await reply_chunked(message, render_offers(
+        f'Offers tagged {", ".join(tags)}:', offers, next_page, empty,
+        seller_names(client, offers)))
 
-        else:
-            await message.reply('I don\'t know that sub-command!')
 
-    except AccountIDError as e:
-        print(e)
-        await message.reply('You don\'t have an account.')
+@subcommand('tag', 'list', max_args=0, usage='tag list')
+async def subcmd_list(client, message, args):
+    ''' List the most used tags with how many offers have each '''
+
+    tags = await cs.getTopTags(TAG_LIST_SIZE)
+
+    if not tags:
+        await message.reply('No offers have tags yet.')
+        return
+
+    lines = [f'{tag} ({count})' for tag, count in tags]
+    await message.reply('Most used tags:\n' + '\n'.join(lines))
@@ -1,15 +1,17 @@
-from .mutual_credit import credit_system as cs
+from .mutual_credit import async_credit_system as cs
 from .mutual_credit.errors import (
     AccountIDError,
     MaxBalanceError,
     MinBalanceError,
+    OfferIDError,
     SelfTransactionError,
     TransactionIDError,
     TransactionStatusError,
     UserPermissionError
 )
 
-from .utils import role_check, user_from_id
+from .commands import subcommand
+from .utils import from_public_id, to_public_id
 
 import shlex
 import logging
@@ -17,74 +19,85 @@ import logging
 log = logging.getLogger(__name__)
 
 
+@subcommand('transaction', 'approve', min_args=1,
+            usage='transaction approve TRANSACTION_ID [TRANSACTION_ID ...]',
+            writes=True, cost=len)
 async def subcmd_approve(client, message, args):
     ''' Approve one or more transactions for caller '''
 
-    if len(args) < 1:
-        raise Exception('You must provide at least one transaction ID.')
-
     user = message.author
     tx_ids = args
+    tx_keys = [from_public_id(tx_id) for tx_id in tx_ids]
+    report = await cs.approveTransactions(user.id, tx_keys)
     total_txs = len(tx_ids)
     response = ''
 
     for i in range(total_txs):
         tx_id = tx_ids[i]
+        _, result, error = report[i]
 
         if total_txs > 1:
             response += f'{i+1}/{total_txs}:'
 
         try:
-            cs.approveTransaction(user.id, tx_id)
-            balance = cs.getAccountBalance(user.id)
-            buyer_id = cs.getTransactionBuyer(tx_id)
+            if error:
+                raise error
         except TransactionIDError as e:
-            response += f' Skipping transaction {tx_id}. {str(e)}\n'
+            response += f' Skipping transaction {tx_id}.'
+            response += ' A transaction with that ID doesn\'t exist.\n'
         except TransactionStatusError as e:
-            response += f' Skipping transaction {tx_id}. {str(e)}\n'
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Transaction is not pending.\n'
         except MaxBalanceError as e:
-            response += f' Skipping transaction {tx_id}. {str(e)}\n'
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Your balance is too high.\n'
         except MinBalanceError as e:
-            response += f' Skipping transaction {tx_id}. {str(e)}\n'
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Buyer\'s balance is too low.\n'
         except UserPermissionError as e:
-            response += f' Skipping transaction {tx_id}. {str(e)}\n'
+            response += f' Skipping transaction {tx_id}.'
+            response += ' You are not the seller for this transaction.\n'
+        except OfferIDError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Its offer no longer exists.\n'
+        except AccountIDError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Its account no longer exists.\n'
         else:
             response += f' Approved transaction {tx_id}.\n'
-            response += f'New balance: ${balance}\n'
+            response += f'New balance: ${result.seller.balance}\n'
 
-            buyer = await user_from_id(client, buyer_id)
-            if buyer:
-                await buyer.create_dm()
-                content = f'{user.name} approved your buy request with'
-                content += f' ID {tx_id}'
-                await buyer.dm_channel.send(content)
+    # the other member is notified through the outbox
+    client.outbox.wake()
 
     # remove last line break
     response = response[:-1]
     await message.reply(response)
 
 
+@subcommand('transaction', 'cancel', min_args=1,
+            usage='transaction cancel TRANSACTION_ID [TRANSACTION_ID ...]',
+            writes=True, cost=len)
 async def subcmd_cancel(client, message, args):
     ''' Cancel one or many transactions created by caller '''
 
-    if len(args) < 1:
-        raise Exception('You must provide at least one trannsaction ID.')
-
     user = message.author
     tx_ids = args
+    tx_keys = [from_public_id(tx_id) for tx_id in tx_ids]
+    report = await cs.cancelTransactions(user.id, tx_keys)
 
     total_txs = len(tx_ids)
     response = ''
     for i in range(total_txs):
         tx_id = tx_ids[i]
+        _, result, error = report[i]
 
         if total_txs > 1:
             response += f'{i+1}/{total_txs}:'
 
         try:
-            cs.cancelTransaction(user.id, tx_id)
-            balance = cs.getAvailableBalance(user.id)
-            seller_id = cs.getTransactionSeller(tx_id)
+            if error:
+                raise error
         except TransactionIDError as e:
             response += f' Skipping transaction {tx_id}.'
             response += ' A transaction with that ID doesn\'t exist.\n'
@@ -93,45 +106,48 @@ async def subcmd_cancel(client, message, args):
             response += ' You are not the buyer for this transaction.\n'
         except TransactionStatusError as e:
             response += f' Skipping transaction {tx_id}.'
-            response += ' Transaction is not pending.'
+            response += ' Transaction is not pending.\n'
+        except OfferIDError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Its offer no longer exists.\n'
+        except AccountIDError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Its account no longer exists.\n'
         else:
             response += f' Cancelled transaction {tx_id}.\n'
-            response += f'New available balance: ${balance}\n'
+            response += f'New available balance: ${result.buyer.available_balance}\n'
 
-            seller = await user_from_id(client, seller_id)
-            if seller:
-                await seller.create_dm()
-                content = f'{seller.name} cancelled their transaction request with'
-                content += f' ID {tx_id}'
-                await seller.dm_channel.send(content)
+    # the other member is notified through the outbox
+    client.outbox.wake()
 
     # remove last line break
     response = response[:-1]
     await message.reply(response)
 
 
+@subcommand('transaction', 'deny', min_args=1,
+            usage='transaction deny TRANSACTION_ID [TRANSACTION_ID ...]',
+            writes=True, cost=len)
 async def subcmd_deny(client, message, args):
     ''' Deny one or more transactions for caller '''
 
-    if len(args) < 1:
-        raise Exception('You must provide at least one trannsaction ID.')
-
     user = message.author
     tx_ids = args
+    tx_keys = [from_public_id(tx_id) for tx_id in tx_ids]
+    report = await cs.denyTransactions(user.id, tx_keys)
 
     total_txs = len(tx_ids)
     response = ''
     for i in range(total_txs):
         tx_id = tx_ids[i]
+        _, result, error = report[i]
 
         if total_txs > 1:
             response += f'{i+1}/{total_txs}:'
 
         try:
-            cs.denyTransaction(user.id, tx_id)
-            pending_credits = cs.getTotalPendingCredits(user.id)
-            buyer_id = cs.getTransactionBuyer(tx_id)
-            buyer_available = cs.getAvailableBalance(buyer_id)
+            if error:
+                raise error
         except TransactionIDError as e:
             response += f' Skipping transaction {tx_id}.'
             response += ' A transaction with that ID doesn\'t exist.\n'
@@ -144,46 +160,51 @@ async def subcmd_deny(client, message, args):
         except UserPermissionError as e:
             response += f' Skipping transaction {tx_id}.'
             response += ' You are not the seller for this transaction.\n'
+        except TransactionStatusError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Transaction is not pending.\n'
+        except OfferIDError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Its offer no longer exists.\n'
+        except AccountIDError as e:
+            response += f' Skipping transaction {tx_id}.'
+            response += ' Its account no longer exists.\n'
         else:
             response += f' Denied transaction {tx_id}.\n'
-            response += f'New pending credits: ${pending_credits}\n'
-            # notify buyer that seller denied their request
-            buyer = await user_from_id(client, buyer_id)
-            if buyer:
-                await buyer.create_dm()
-                content = f'{user.name} denied your transaction request: '
-                content += f'{tx_id}\n'
-                content += f'New available balance: ${buyer_available}\n'
-                await buyer.dm_channel.send(content)
+            response += f'New pending credits: ${result.seller.pending_credits}\n'
+
+    # buyers/sellers are notified through the outbox
+    client.outbox.wake()
 
     # remove last line break
     response = response[:-1]
     await message.reply(response)
 
 
+@subcommand('transaction', 'request', min_args=1,
+            usage='transaction request OFFER_ID [OFFER_ID ...]', writes=True,
+            cost=len)
 async def subcmd_request(client, message, args):
     ''' Create one or more transactions for caller '''
 
-    if len(args) < 1:
-        raise Exception('You must provide one or more offer IDs.')
-
     user = message.author
     offer_ids = args
+    offer_keys = [from_public_id(offer_id) for offer_id in offer_ids]
+    report = await cs.createTransactions(user.id, offer_keys)
 
     total_offers = len(offer_ids)
     response = ''
     for i in range(total_offers):
         offer_id = offer_ids[i]
+        _, result, error = report[i]
 
         if total_offers > 1:
             response += f'{i+1}/{total_offers}:'
 
         try:
-            tx_id = cs.createTransaction(user.id, offer_id)
-            available_balance = cs.getAvailableBalance(user.id)
-            seller_id = cs.getOfferSeller(offer_id)
-            offer_title = cs.getOfferTitle(offer_id)
-        except TransactionIDError as e:
+            if error:
+                raise error
+        except OfferIDError as e:
             response += f' Skipping offer {offer_id}.'
             response += ' An offer with that ID doesn\'t exist.\n'
         except MinBalanceError as e:
@@ -191,76 +212,17 @@ async def subcmd_request(client, message, args):
             response += ' You\'re balance is too low.\n'
         except SelfTransactionError as e:
             response += f' Skipping offer {offer_id}.'
-            response += ' You can\'t buy your own offer.'
+            response += ' You can\'t buy your own offer.\n'
+        except AccountIDError as e:
+            response += f' Skipping offer {offer_id}.'
+            response += ' Its seller no longer has an account.\n'
         else:
-            response += f' Created buy request with ID {tx_id}.\n'
-            response += f'New available balance: ${available_balance}\n'
-            # notify seller
-            seller = await user_from_id(client, seller_id)
-            if seller:
-                await seller.create_dm()
-                content = f'New buy request with ID {tx_id}'
-                content += f' from {user.name} for {offer_title}.'
-                await seller.dm_channel.send(content)
-
-            else:
-                print('Seller not found, which is weird.')
+            response += f' Created buy request with ID {to_public_id(result.tx_id)}.\n'
+            response += f'New available balance: ${result.buyer.available_balance}\n'
+
+    # buyers/sellers are notified through the outbox
+    client.outbox.wake()
 
     # remove last line break
     response = response[:-1]
     await message.reply(response)
-
-
-async def handle(client, message, args):
-    if len(args) < 1:  # TODO: Add an CommandArgumentsError
-        raise Exception('Invalid number of arguments')
-
-    subcmd = args[0]
-    args = args[1:]
-
-    user = message.author
-    is_admin = await role_check(client, user.id, 'admin')
-    is_member = await role_check(client, user.id, 'member')
-
-    try:
-        # non-member sub-commands up here
-
-        # member-only sub-commands down here
-
-        if not is_member:
-            raise Exception('You are not a member.')
-
-        if subcmd == 'approve':
-            try:
-                await subcmd_approve(client, message, args)
-
-            except AccountIDError as e:
-                raise e
-
-        elif subcmd == 'cancel':
-            try:
-                await subcmd_cancel(client, message, args)
-
-            except AccountIDError as e:
-                raise e
-
-        elif subcmd == 'deny':
-            try:
-                await subcmd_deny(client, message, args)
-
-            except AccountIDError as e:
-                raise e
-
-        elif subcmd == 'request':
-            try:
-                await subcmd_request(client, message, args)
-
-            except AccountIDError as e:
-                raise e
-
-        else:
-            await message.reply('I don\'t know that sub-command!')
-
-    except AccountIDError as e:
-        print(e)
-        await message.reply('You don\'t have an account.')
@@ -6,46 +6,19 @@ import logging
 log = logging.getLogger(__name__)
 
 
-async def role_check(client, account_id, role_name):
-    log.debug(f'role_check: arguments=({account_id}, {role_name})')
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
 
-    all_roles = []
+# Crockford's base32: no I, L, O or U, so IDs are hard to misread
+PUBLIC_ID_ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+_PUBLIC_ID_ALIASES = {'i': '1', 'l': '1', 'o': '0'}
 
-    for guild in client.guilds:
-        all_roles += guild.roles
 
-    allowed_role = discord.utils.find(lambda r: r.name==role_name, all_roles)
-
-    if not allowed_role:
-        log.error(f'role_check: role "{role_name}" is not known by client')
-
-    user = discord.utils.find(lambda m: m.id==account_id, client.get_all_members())
-
-    if not user:
-        log.debug(f'role_check: user with ID "{account_id}" not found in client members list')
-
-    if allowed_role in user.roles:
-        log.debug(f'role_check: pass')
-        return True
-
-    log.debug(f'role_check: fail')
-
-    return False
-
-
-def find_subcommands(module):
-    subcmds = []
-
-    for name in dir(module):
-        item = getattr(module, name)
-
-        if str(type(item)) != "<class 'function'>":
-            continue
-
-        if not name.startswith('subcmd_'):
-            continue
-
-        subcmds.append(name)
+def get_roles(client, account_id):
+    ''' Names of every role the member has, in any guild the client is in '''
+    roles = client.roles_for(account_id)
+    log.debug(f'get_roles: {account_id} has {sorted(roles)}')
+    return roles
 
 
 def mention_to_id(mention):
@@ -64,7 +37,95 @@ def mention_to_id(mention):
         return None
 
 
+def to_public_id(key):
+    ''' The ID members see for an offer or transaction key '''
+    digits = ''
+
+    while True:
+        key, digit = divmod(key, 32)
+        digits = PUBLIC_ID_ALPHABET[digit] + digits
+        if key == 0:
+            return digits
+
+
+def from_public_id(public_id):
+    ''' The offer or transaction key for a public ID, None if it isn't one '''
+    digits = public_id.strip().lower()
+    key = 0
+
+    # only the form to_public_id produces, so each key has one spelling
+    if not digits or (len(digits) > 1 and digits[0] in '0o'):
+        return None
+
+    for char in digits:
+        char = _PUBLIC_ID_ALIASES.get(char, char)
+        digit = PUBLIC_ID_ALPHABET.find(char)
+
+        if digit < 0:
+            return None
+
+        key = key * 32 + digit
+
+    # longer than a SQLite integer can hold
+    if key >= 2 ** 63:
+        return None
+
+    return key
+
+
 async def user_from_id(client, user_id):
-    user = get(client.get_all_members(), id=user_id)
+    user = client.member_for(user_id)
 
     return user
+
+
+# background workers are started from on_ready, which can fire again after a
+# reconnect, so they check this first instead of starting a second copy
+def tasks_running(tasks):
+    ''' True if any of the tasks (None for never started) is unfinished '''
+    return any(task is not None and not task.done() for task in tasks)
+
+
+async def as_async_iter(rows):
+    if hasattr(rows, '__aiter__'):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
+
+
+async def iter_chunks(rows, limit=MESSAGE_LIMIT, separator='\n\n'):
+    ''' Pack rendered rows (a sync or async iterable) into message-sized chunks '''
+    chunk = ''
+
+    async for row in as_async_iter(rows):
+        # a row that can't fit in a message on its own is split
+        while len(row) > limit:
+            if chunk:
+                yield chunk
+                chunk = ''
+            yield row[:limit]
+            row = row[limit:]
+
+        if not chunk:
+            chunk = row
+        elif len(chunk) + len(separator) + len(row) <= limit:
+            chunk += separator + row
+        else:
+            yield chunk
+            chunk = row
+
+    if chunk:
+        yield chunk
+
+
+async def reply_chunked(message, rows, limit=MESSAGE_LIMIT, separator='\n\n'):
+    ''' Reply with rows as they are produced, as few messages as possible '''
+    replies = 0
+
+    async for chunk in iter_chunks(rows, limit, separator):
+        await message.reply(chunk)
+        replies += 1
+
+    return replies
@@ -1,20 +1,23 @@
-from bot.client import client
-
 from dotenv import load_dotenv
+
+# load before importing the bot so module-level settings see .env values
+load_dotenv()
+
 import os
 import logging
 
 log = logging.getLogger(__name__)
 
-load_dotenv()
-
 
+# configured before importing the bot so its startup messages are logged
 logging.basicConfig(filename=os.getenv('LOG_FILE', 'log.txt'),
                     filemode='a',
                     format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
                     datefmt='%H:%M:%S',
                     level=os.getenv('LOG_LEVEL', logging.INFO))
 
+from bot.client import client
+
 
 
 